@@ -16,18 +16,19 @@ from ...utils import create_transaction, TransactionKind
 
 from ...models import Payment
 
+from .db import get_read_db
 from .forms import SberbankPaymentForm
 from . import errors
 from .utils import (
     get_amount_for_sberbank,
     get_error_response,
     get_return_url,
-    get_data_for_payment)
+    get_data_for_payment,
+    get_channel_slug,
+    get_client)
 
 from . import client as sberbank
 
-from .tasks import check_status_sberbank_task
-
 # The list of currencies supported by razorpay
 SUPPORTED_CURRENCIES = ("RUB", "USD")
 PENDING_STATUSES = [""]
@@ -38,6 +39,8 @@ SBERBANK_EXCEPTIONS = (
     sberbank.errors.BadRequestError,
     sberbank.errors.GatewayError,
     sberbank.errors.ServerError,
+    sberbank.errors.RateLimitError,
+    sberbank.errors.CircuitOpenError,
 )
 
 # Get the logger for this file, it will allow us to log
@@ -63,14 +66,6 @@ def check_payment_supported(payment_information: PaymentData):
         return errors.UNSUPPORTED_CURRENCY % {"currency": payment_information.currency}
 
 
-def get_client(connection_params):
-    """Create a Sberbank client from set-up application keys."""
-    sberbank_client = sberbank.Client(
-        auth=(connection_params['login'], connection_params['password']),
-        sandbox=connection_params['sandbox_mode'])
-    return sberbank_client
-
-
 def process_payment(self, payment_information: PaymentData, config: GatewayConfig
                     ) -> GatewayResponse:
     # return authorize(payment_information, config)
@@ -98,20 +93,40 @@ def process_payment(self, payment_information: PaymentData, config: GatewayConfi
 
     error = check_payment_supported(payment_information=payment_information)
 
-    sberbank_client = get_client(config.connection_params)
+    sberbank_client = get_client(config.connection_params, get_channel_slug(checkout))
 
-    try:
+    kind = TransactionKind.AUTH
+    sberbank_auto_capture = self.config.auto_capture
+    if sberbank_auto_capture:
+        kind = TransactionKind.CAPTURE
 
-        kind = TransactionKind.AUTH
-        sberbank_auto_capture = self.config.auto_capture
-        if sberbank_auto_capture:
-            kind = TransactionKind.CAPTURE
+    try:
+        data = get_data_for_payment(
+            payment_information,
+            session_timeout=config.connection_params.get('session_timeout'),
+            checkout=checkout,
+            connection_params=config.connection_params)
+    except ValueError as exc:
+        # A product type with an unsupported VAT rate in its metadata.
+        logger.error('Sberbank receipt of payment %s not built: %s',
+                     payment_information.payment_id, exc)
+        return GatewayResponse(
+            is_success=False,
+            action_required=False,
+            kind=kind,
+            amount=payment_information.amount,
+            currency=payment_information.currency,
+            transaction_id='',
+            error=str(exc),
+            customer_id=payment_information.customer_id,
+        )
 
+    try:
         response = sberbank_client.payment.register(
             order_id=payment_information.payment_id,
             amount=get_amount_for_sberbank(payment_information.amount),
             return_url=return_url,
-            data=get_data_for_payment(payment_information))
+            data=data)
         # response = {"formUrl": "https://3dsec.sberbank.ru/payment/merchants/sbersafe_id/payment_ru.html?mdOrder=389320f5-d423-714b-bae5-ca325e3d5a10",
         #             "orderId": "389320f5-d423-714b-bae5-ca325e3d5a10"}
 
@@ -183,7 +198,9 @@ def confirm_payment(
     config = self._get_gateway_config()
     # The additional checks are proceed asynchronously so we try to confirm that
     # the payment is already processed
-    payment = Payment.objects.filter(id=payment_information.payment_id).first()
+    read_db = get_read_db(config.connection_params, payment_information.payment_id)
+    # Transactions are read through the payment, from the same database.
+    payment = Payment.objects.using(read_db).filter(id=payment_information.payment_id).first()
     if not payment:
         raise PaymentError("Unable to find the payment.")
 
@@ -0,0 +1,142 @@
+"""Time the pure-Python code every payment runs and gate regressions.
+
+Nothing touches the network or the database. Timings are stored relative to
+a fixed calibration loop, so a baseline saved on one machine stays usable on
+another. Runs through a management command, the plugin package needs Django
+set up before it is imported:
+
+    python manage.py benchmark_sberbank --save
+    python manage.py benchmark_sberbank
+
+The comparison fails when a benchmark is slower than its baseline by more
+than the threshold.
+"""
+import json
+import os
+import statistics
+import timeit
+from decimal import Decimal
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_ROUNDS = 5
+
+
+def calibration():
+    return sum(index * index for index in range(1000))
+
+
+def make_benchmarks():
+    """Return the benchmarked callables, imported after Django is set up."""
+    from .. import client as sberbank
+    from ..client import client as client_module
+    from ..errors import ERRORS
+    from ..utils import get_amount_for_sberbank, is_success_response
+    from ..webhooks import prepare_redirect_url
+
+    client = sberbank.Client(auth=("merchant-api", "password"))
+    failed_code = sorted(ERRORS)[-1]
+
+    return {
+        "calibration": calibration,
+        "get_amount_for_sberbank": lambda: get_amount_for_sberbank(Decimal("12345.67")),
+        "update_request": lambda: client._update_request(
+            {"orderNumber": "42", "amount": 1234567, "returnUrl": "https://example.com"},
+            {},
+        ),
+        "resource_discovery": lambda: client_module.get_resource_classes(
+            sberbank.resources
+        ),
+        "classify_success": lambda: is_success_response({"errorCode": "0"}),
+        "classify_failure": lambda: is_success_response({"errorCode": failed_code}),
+        "prepare_redirect_url": lambda: prepare_redirect_url(
+            "UGF5bWVudDox",
+            "8f1b7a3e-2c44-4f0e-9d4b-5b6a1e2f3c4d",
+            {"errorMessage": "Успешно"},
+            "https://example.com/checkout/payment-confirm",
+        ),
+    }
+
+
+def measure(func, repeat):
+    """Best time of a single call in seconds."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(repeat=7):
+    """Return call times in seconds and relative to the calibration loop.
+
+    The calibration loop is timed again before every benchmark and the fastest
+    run is kept, a single timing is too noisy on shared machines.
+    """
+    benchmarks = make_benchmarks()
+    calibrate = benchmarks.pop("calibration")
+    absolute = {}
+    calibration_time = measure(calibrate, repeat)
+    for name, func in benchmarks.items():
+        calibration_time = min(calibration_time, measure(calibrate, repeat))
+        absolute[name] = measure(func, repeat)
+    relative = {name: elapsed / calibration_time for name, elapsed in absolute.items()}
+    return absolute, relative
+
+
+def run_rounds(rounds=DEFAULT_ROUNDS, repeat=7):
+    """Return the median absolute and relative times of several rounds."""
+    results = [run(repeat) for _ in range(rounds)]
+    return tuple(
+        {
+            name: statistics.median(result[index][name] for result in results)
+            for name in results[0][index]
+        }
+        for index in (0, 1)
+    )
+
+
+def compare(relative, baseline, threshold, write=print):
+    """Return the names of benchmarks slower than baseline by over `threshold`."""
+    regressions = []
+    for name, value in relative.items():
+        expected = baseline.get(name)
+        if expected is None:
+            write("{:<26} no baseline".format(name))
+            continue
+        change = value / expected - 1
+        regressed = change > threshold
+        write(
+            "{:<26} {:+7.1%}{}".format(name, change, "  REGRESSION" if regressed else "")
+        )
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def run_gate(
+    save=False,
+    baseline_path=BASELINE_PATH,
+    threshold=DEFAULT_THRESHOLD,
+    rounds=DEFAULT_ROUNDS,
+    repeat=7,
+    write=print,
+):
+    """Time the benchmarks, then store them or compare them with the baseline.
+
+    Both the baseline and the comparison use the median of `rounds` runs.
+
+    Returns the names of the regressed benchmarks. Raises FileNotFoundError
+    when there is no baseline to compare with.
+    """
+    absolute, relative = run_rounds(rounds, repeat)
+    for name, elapsed in absolute.items():
+        write("{:<26} {:9.3f} us".format(name, elapsed * 1e6))
+
+    if save:
+        with open(baseline_path, "w") as baseline:
+            json.dump(relative, baseline, indent=2, sort_keys=True)
+            baseline.write("\n")
+        write("Baseline saved to {}".format(baseline_path))
+        return []
+
+    with open(baseline_path) as baseline:
+        return compare(relative, json.load(baseline), threshold, write)
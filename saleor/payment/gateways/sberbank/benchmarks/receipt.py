@@ -0,0 +1,70 @@
+"""Measure how orderBundle build time grows with the cart size.
+
+Uses in-memory lines, so only the payload building is timed. The time per
+line should stay flat from small carts up to 1000 lines.
+
+    DJANGO_SETTINGS_MODULE=saleor.settings \\
+        python -m saleor.payment.gateways.sberbank.benchmarks.receipt
+"""
+import timeit
+from decimal import Decimal
+
+import django
+
+CART_SIZES = (1, 10, 100, 1000)
+PRODUCT_TYPES = 5
+
+
+class ProductType:
+    def __init__(self, pk, vat_rate):
+        self.pk = pk
+        self.charge_taxes = True
+        self.vat_rate = vat_rate
+
+    def get_value_from_metadata(self, key, default=None):
+        return self.vat_rate or default
+
+
+def make_lines(count):
+    product_types = [
+        ProductType(pk, rate)
+        for pk, rate in zip(range(PRODUCT_TYPES), ("20", "10", "0", None, "20"))
+    ]
+    return [
+        (
+            "Product {}".format(index),
+            "SKU-{}".format(index),
+            index % 3 + 1,
+            Decimal("199.90"),
+            product_types[index % PRODUCT_TYPES],
+        )
+        for index in range(count)
+    ]
+
+
+def main(repeat=5):
+    django.setup()
+    from ..receipt import build_order_bundle
+
+    for size in CART_SIZES:
+        lines = make_lines(size)
+        total = sum(quantity * price for _, _, quantity, price, _ in lines)
+        runs = max(1, 2000 // size)
+        best = min(
+            timeit.repeat(
+                lambda: build_order_bundle(
+                    lines, total, email="test@example.com", shipping=("Courier", Decimal("300"))
+                ),
+                number=runs,
+                repeat=repeat,
+            )
+        ) / runs
+        print(
+            "{:>5} lines  {:9.3f} ms  {:7.2f} us/line".format(
+                size, best * 1000, best * 1e6 / size
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Measure what loading the Sberbank plugin costs a process.
+
+Every scenario runs in a fresh interpreter after `django.setup()`, so only
+the plugin modules are counted. The `eager` scenario imports the webhooks
+the way `plugin.py` used to do at module load.
+
+    DJANGO_SETTINGS_MODULE=saleor.settings \\
+        python -m saleor.payment.gateways.sberbank.benchmarks.startup
+"""
+import json
+import subprocess
+import sys
+
+PACKAGE = "saleor.payment.gateways.sberbank"
+
+SCENARIOS = {
+    "lazy": [f"{PACKAGE}.plugin"],
+    "eager": [f"{PACKAGE}.plugin", f"{PACKAGE}.webhooks"],
+}
+
+PROBE = """
+import importlib, json, sys, time
+import django
+
+django.setup()
+
+
+def rss_kb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+rss_before = rss_kb()
+started = time.perf_counter()
+for module in sys.argv[1:]:
+    importlib.import_module(module)
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "rss_kb": rss_kb() - rss_before}))
+"""
+
+
+def measure(modules, repeat):
+    results = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", PROBE, *modules])
+        results.append(json.loads(output))
+    results.sort(key=lambda result: result["seconds"])
+    return results[len(results) // 2]
+
+
+def main(repeat=5):
+    for name, modules in SCENARIOS.items():
+        result = measure(modules, repeat)
+        print(
+            "{:<6} import {:8.1f} ms   rss +{:6d} KiB".format(
+                name, result["seconds"] * 1000, result["rss_kb"]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,154 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, List, Optional
+
+from django.db import transaction
+from django.utils import timezone
+
+from ... import ChargeStatus, TransactionKind
+from ...models import Payment, Transaction
+from .client import PRIORITY
+from .db import mark_written
+from .live_status import publish_status
+from .utils import (
+    get_amount_for_sberbank,
+    get_channel_slug,
+    get_client,
+    get_order_id,
+    is_success_response,
+)
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_CHUNK_SIZE = 200
+CAPTURE_MAX_WORKERS = 8
+
+
+@dataclass
+class CaptureResult:
+    total: int = 0
+    captured: List[int] = field(default_factory=list)
+    failed: List[int] = field(default_factory=list)
+
+    @property
+    def done(self):
+        return len(self.captured) + len(self.failed)
+
+
+def get_capturable_payments(payment_ids: Optional[Iterable[int]] = None):
+    """Return active Sberbank payments that are authorized but not captured."""
+    payments = Payment.objects.filter(
+        gateway="korolev.payments.sberbank",
+        is_active=True,
+        charge_status=ChargeStatus.NOT_CHARGED,
+        transactions__kind=TransactionKind.AUTH,
+        transactions__is_success=True,
+        transactions__action_required=False,
+    ).distinct()
+    if payment_ids is not None:
+        payments = payments.filter(pk__in=payment_ids)
+    return payments
+
+
+def _deposit(payment, order_id, channel_slug, connection_params):
+    amount = payment.total - payment.captured_amount
+    if not order_id:
+        return payment, amount, order_id, {"errorMessage": "Missing Sberbank orderId"}, False
+    client = get_client(connection_params, channel_slug)
+    try:
+        response = client.deposit.create(
+            order_id=order_id,
+            amount=get_amount_for_sberbank(amount),
+            priority=PRIORITY.BACKGROUND,
+        )
+    except Exception as exc:
+        logger.warning("Sberbank deposit of payment %s failed: %s", payment.pk, exc)
+        return payment, amount, order_id, {"errorMessage": str(exc)}, False
+    return payment, amount, order_id, response, is_success_response(response)
+
+
+def _store_captures(results):
+    transactions = []
+    captured_payments = []
+    now = timezone.now()
+    for payment, amount, order_id, response, is_success in results:
+        transactions.append(
+            Transaction(
+                payment=payment,
+                kind=TransactionKind.CAPTURE,
+                token=order_id or "",
+                is_success=is_success,
+                action_required=False,
+                amount=amount,
+                currency=payment.currency,
+                error="" if is_success else response.get("errorMessage", ""),
+                gateway_response=response,
+                searchable_key=order_id or "",
+            )
+        )
+        if is_success:
+            payment.captured_amount += amount
+            payment.charge_status = ChargeStatus.FULLY_CHARGED
+            payment.modified = now
+            captured_payments.append(payment)
+
+    with transaction.atomic():
+        Transaction.objects.bulk_create(transactions)
+        Payment.objects.bulk_update(
+            captured_payments, ["captured_amount", "charge_status", "modified"]
+        )
+    mark_written(*[payment.pk for payment, *_ in results])
+    publish_status(*[payment.pk for payment in captured_payments])
+    return [payment.pk for payment in captured_payments]
+
+
+def capture_payments(
+    payments,
+    connection_params,
+    max_workers: int = CAPTURE_MAX_WORKERS,
+    chunk_size: int = CAPTURE_CHUNK_SIZE,
+    progress: Optional[Callable[[CaptureResult], None]] = None,
+) -> CaptureResult:
+    """Capture authorized two-stage payments with `deposit.do`.
+
+    Payments are processed in chunks. Deposits of a chunk run concurrently at
+    background priority, so the merchant rate limit still keeps room for
+    customers, then the CAPTURE transactions of the chunk are written in bulk.
+    """
+    payment_ids = list(payments.values_list("pk", flat=True))
+    result = CaptureResult(total=len(payment_ids))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(payment_ids), chunk_size):
+            chunk = list(
+                Payment.objects.filter(pk__in=payment_ids[start : start + chunk_size])
+                .select_related("order", "checkout")
+                .prefetch_related("transactions")
+            )
+            # Everything touching the database is resolved here, worker threads
+            # only talk to Sberbank.
+            futures = [
+                executor.submit(
+                    _deposit,
+                    payment,
+                    get_order_id(payment),
+                    get_channel_slug(payment.order or payment.checkout),
+                    connection_params,
+                )
+                for payment in chunk
+            ]
+            results = [future.result() for future in futures]
+            captured = set(_store_captures(results))
+            result.captured.extend(p.pk for p in chunk if p.pk in captured)
+            result.failed.extend(p.pk for p in chunk if p.pk not in captured)
+            if progress:
+                progress(result)
+
+    logger.info(
+        "Sberbank batch capture finished: %s captured, %s failed of %s",
+        len(result.captured),
+        len(result.failed),
+        result.total,
+    )
+    return result
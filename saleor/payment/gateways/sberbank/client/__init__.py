@@ -1,11 +1,22 @@
 from .client import Client
+from .circuit import CircuitBreaker
+from .pool import ClientPool, client_pool
 from .constants import ERROR_CODE
 from .constants import HTTP_STATUS_CODE
+from .constants import PRIORITY
+from .constants import ORDER_STATUS
+from .models import OrderStatus
 from . import errors
 from . import resources
 
 __all__ = [
     'Client',
+    'CircuitBreaker',
+    'ClientPool',
+    'client_pool',
     'HTTP_STATUS_CODE',
     'ERROR_CODE',
+    'PRIORITY',
+    'ORDER_STATUS',
+    'OrderStatus',
 ]
@@ -1,25 +1,64 @@
+import asyncio
+import functools
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
-from .constants import HTTP_STATUS_CODE, ERROR_CODE, URL
+from .constants import HTTP_STATUS_CODE, ERROR_CODE, URL, PRIORITY
 
 from .errors import (BadRequestError,
+                     CircuitOpenError,
                      GatewayError,
+                     RateLimitError,
                      ServerError)
 
 from . import resources
+from .endpoints import EndpointSelector
+from .metrics import ClientMetrics
 from types import ModuleType
 
 
+def is_connect_error(exc):
+    """
+    Tells whether a requests error happened before anything was sent
+
+    requests raises ConnectionError also for connections dropped after the
+    body was sent, those must not be retried elsewhere.
+    """
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
 def capitalize_camel_case(string):
     return "".join(map(str.capitalize, string.split('_')))
 
 
+def get_resource_classes(package):
+    """
+    Maps every resource module of the package to its resource class
+    """
+    resource_classes = {}
+    for name, module in package.__dict__.items():
+        if isinstance(module, ModuleType):
+            class_name = capitalize_camel_case(name)
+            if class_name in module.__dict__:
+                resource_classes[name] = module.__dict__[class_name]
+    return resource_classes
+
+
 # Create a dict of resource classes
-RESOURCE_CLASSES = {}
-for name, module in resources.__dict__.items():
-    if isinstance(module, ModuleType) and \
-            capitalize_camel_case(name) in module.__dict__:
-        RESOURCE_CLASSES[name] = module.__dict__[capitalize_camel_case(name)]
+RESOURCE_CLASSES = get_resource_classes(resources)
 
 
 class Client:
@@ -30,6 +69,7 @@ class Client:
         'sandbox_url': URL.SANDBOX_URL,
         'status_url': URL.STATUS_URL,
         'register_url': URL.REGISTER_URL,
+        'acquire_timeout': 30,
     }
 
     def __init__(self, session=None, auth=None, sandbox=True, **options):
@@ -39,12 +79,28 @@ class Client:
         """
         self.session = session or requests.Session()
         self.auth = auth
+        self.metrics = options.pop('metrics', None) or ClientMetrics()
+        self.limiter = options.pop('limiter', None)
+        self.circuit = options.pop('circuit', None)
+        # httpx clients are bound to the event loop they were used in, Django
+        # runs every async view of a WSGI server in a new loop
+        self._async_sessions = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
+        self.acquire_timeout = options.pop('acquire_timeout',
+                                           self.DEFAULTS['acquire_timeout'])
+        alternate_endpoints = options.pop('endpoints', None) or ()
 
         if sandbox:
             self.base_url = self._set_sandbox_url(**options)
         else:
             self.base_url = self._set_base_url(**options)
 
+        # The configured base URL comes first, alternates are equivalent
+        # hosts or proxies of the same API
+        self.endpoints = EndpointSelector(
+            [self.base_url] +
+            [url for url in alternate_endpoints if url != self.base_url])
+
         # intializes each resource
         # injecting this client object into the constructor
         for name, Klass in RESOURCE_CLASSES.items():
@@ -71,19 +127,147 @@ class Client:
     def request(self, method, path, **options):
         """
         Dispatches a request to the Sberbank HTTP API
+
+        The `priority` option decides who goes first when the merchant
+        is rate limited, see PRIORITY, `rate_limited=False` skips the
+        limiter for cheap diagnostic calls. The request goes to the healthiest
+        endpoint and fails over to the next one when it cannot connect.
+        """
+
+        priority = options.pop('priority', PRIORITY.INTERACTIVE)
+        rate_limited = options.pop('rate_limited', True)
+        if self.limiter is not None and rate_limited and \
+                not self.limiter.acquire(priority, self.acquire_timeout):
+            raise RateLimitError("Sberbank API rate limit exceeded")
+        self._check_circuit()
+
+        self.metrics.request_started()
+        started = time.monotonic()
+        status_code = None
+        try:
+            endpoints = self.endpoints.ranked()
+            for attempt, endpoint in enumerate(endpoints, 1):
+                url = "{}{}".format(endpoint.url, path)
+                self.metrics.endpoint_chosen(endpoint.url)
+                attempt_started = time.monotonic()
+                try:
+                    response = getattr(self.session, method)(
+                        url, auth=self.auth, **options)
+                except requests.ConnectionError as exc:
+                    self.endpoints.record_connection_error(endpoint)
+                    # Only errors of the connect phase fail over, anything
+                    # later may come after Sberbank got the request
+                    if attempt == len(endpoints) or not is_connect_error(exc):
+                        raise
+                    self.metrics.failover()
+                    continue
+                self._record_endpoint(endpoint, attempt_started,
+                                      response.status_code)
+                status_code = response.status_code
+                break
+        finally:
+            self._record_request(started, status_code)
+
+        return self._handle_response(response.status_code, response.json)
+
+    async def arequest(self, method, path, **options):
         """
+        Dispatches a request to the Sberbank HTTP API without blocking
 
-        url = "{}{}".format(self.base_url, path)
+        Uses httpx when it is installed, otherwise runs the blocking
+        request in the default executor.
+        """
+        loop = asyncio.get_running_loop()
+        if httpx is None:
+            return await loop.run_in_executor(
+                None, functools.partial(self.request, method, path, **options))
+
+        priority = options.pop('priority', PRIORITY.INTERACTIVE)
+        rate_limited = options.pop('rate_limited', True)
+        if self.limiter is not None and rate_limited:
+            acquired = await loop.run_in_executor(
+                None, self.limiter.acquire, priority, self.acquire_timeout)
+            if not acquired:
+                raise RateLimitError("Sberbank API rate limit exceeded")
+        self._check_circuit()
+
+        self.metrics.request_started()
+        started = time.monotonic()
+        status_code = None
+        try:
+            endpoints = self.endpoints.ranked()
+            for attempt, endpoint in enumerate(endpoints, 1):
+                url = "{}{}".format(endpoint.url, path)
+                self.metrics.endpoint_chosen(endpoint.url)
+                attempt_started = time.monotonic()
+                try:
+                    response = await self._get_async_session().request(
+                        method, url, auth=self.auth, **options)
+                except (httpx.ConnectError, httpx.ConnectTimeout) as exc:
+                    self.endpoints.record_connection_error(endpoint)
+                    if attempt == len(endpoints):
+                        raise requests.ConnectionError(str(exc)) from exc
+                    self.metrics.failover()
+                    continue
+                except httpx.TransportError as exc:
+                    # Callers handle outages as requests errors, whatever
+                    # the transport.
+                    raise requests.ConnectionError(str(exc)) from exc
+                self._record_endpoint(endpoint, attempt_started,
+                                      response.status_code)
+                status_code = response.status_code
+                break
+        finally:
+            self._record_request(started, status_code)
+
+        return self._handle_response(response.status_code, response.json)
+
+    def _get_async_session(self):
+        """
+        Returns the httpx client of the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            async_session = self._async_sessions.get(loop)
+            if async_session is None:
+                adapter = self.session.get_adapter(self.base_url)
+                max_connections = getattr(adapter, '_pool_maxsize', None)
+                async_session = httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=max_connections))
+                self._async_sessions[loop] = async_session
+        return async_session
+
+    def _record_endpoint(self, endpoint, started, status_code):
+        self.endpoints.record_response(
+            endpoint, time.monotonic() - started,
+            status_code >= HTTP_STATUS_CODE.SERVER_ERROR)
+
+    def _check_circuit(self):
+        if self.circuit is not None and not self.circuit.allow():
+            raise CircuitOpenError("Sberbank API is unavailable")
+
+    def _record_request(self, started, status_code):
+        """
+        Updates metrics and the circuit, status_code is None on errors
+        """
+        failed = status_code is None or \
+            status_code >= HTTP_STATUS_CODE.REDIRECT
+        self.metrics.request_finished(time.monotonic() - started, failed)
+        if self.circuit is not None:
+            if status_code is None or \
+                    status_code >= HTTP_STATUS_CODE.SERVER_ERROR:
+                self.circuit.record_failure()
+            else:
+                self.circuit.record_success()
 
-        response = getattr(self.session, method)(url, auth=self.auth,
-                                                 **options)
-        if ((response.status_code >= HTTP_STATUS_CODE.OK) and
-                (response.status_code < HTTP_STATUS_CODE.REDIRECT)):
-            return response.json()
+    def _handle_response(self, status_code, get_json):
+        if ((status_code >= HTTP_STATUS_CODE.OK) and
+                (status_code < HTTP_STATUS_CODE.REDIRECT)):
+            return get_json()
         else:
             msg = ""
             code = ""
-            json_response = response.json()
+            json_response = get_json()
             if 'error' in json_response:
                 if 'description' in json_response['error']:
                     msg = json_response['error']['description']
@@ -99,6 +283,29 @@ class Client:
             else:
                 raise ServerError(msg)
 
+    def warm_up(self, connections, timeout=5):
+        """
+        Opens keep-alive connections to the Sberbank host in advance.
+
+        The requests run concurrently so each of them takes a separate
+        connection, which then stays in the session pool.
+        """
+        started = time.monotonic()
+        endpoint = self.endpoints.ranked()[0].url
+
+        def open_connection(_):
+            try:
+                self.session.head(endpoint, timeout=timeout)
+            except requests.RequestException:
+                pass
+
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            list(executor.map(open_connection, range(connections)))
+
+        elapsed = time.monotonic() - started
+        self.metrics.warm_up_finished(elapsed)
+        return elapsed
+
     def get(self, path, params, **options):
         """
         Parses GET request options and dispatches a request
@@ -112,6 +319,13 @@ class Client:
         data, options = self._update_request(data, options)
         return self.request('post', path, data=data, **options)
 
+    async def apost(self, path, data, **options):
+        """
+        Parses POST request options and dispatches a non-blocking request
+        """
+        data, options = self._update_request(data, options)
+        return await self.arequest('post', path, data=data, **options)
+
     def patch(self, path, data, **options):
         """
         Parses PATCH request options and dispatches a request
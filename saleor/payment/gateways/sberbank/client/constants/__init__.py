@@ -1,9 +1,13 @@
 from .http_status_code import HTTP_STATUS_CODE
 from .error_code import ERROR_CODE
 from .url import URL
+from .priority import PRIORITY
+from .order_status import ORDER_STATUS
 
 __all__ = [
         'HTTP_STATUS_CODE',
         'ERROR_CODE',
         'URL',
+        'PRIORITY',
+        'ORDER_STATUS',
 ]
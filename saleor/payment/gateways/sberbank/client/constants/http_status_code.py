@@ -1,3 +1,4 @@
 class HTTP_STATUS_CODE(object):
     OK = 200
     REDIRECT = 300
+    SERVER_ERROR = 500
@@ -0,0 +1,11 @@
+class ORDER_STATUS(object):
+    REGISTERED = 0
+    APPROVED = 1
+    DEPOSITED = 2
+    REVERSED = 3
+    REFUNDED = 4
+    ACS_AUTHORIZATION = 5
+    DECLINED = 6
+
+    PAID = (APPROVED, DEPOSITED)
+    TERMINAL = (APPROVED, DEPOSITED, REVERSED, REFUNDED, DECLINED)
@@ -0,0 +1,3 @@
+class PRIORITY(object):
+    INTERACTIVE = 0
+    BACKGROUND = 1
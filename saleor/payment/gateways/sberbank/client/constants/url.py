@@ -3,3 +3,7 @@ class URL(object):
     SANDBOX_URL = 'https://3dsec.sberbank.ru/payment/rest'
     REGISTER_URL = '/register.do'
     STATUS_URL = '/getOrderStatusExtended.do'
+    STATUS_PROBE_URL = '/getOrderStatus.do'
+    DEPOSIT_URL = '/deposit.do'
+    REFUND_URL = '/refund.do'
+    REVERSE_URL = '/reverse.do'
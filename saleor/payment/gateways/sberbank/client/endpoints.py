@@ -0,0 +1,104 @@
+import threading
+import time
+
+
+class Endpoint(object):
+    """
+    Moving latency and error scores of one Sberbank base URL
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.updated_at = time.monotonic()
+        self.unavailable_until = 0.0
+
+
+class EndpointSelector(object):
+    """
+    Sends requests to the healthiest of equivalent endpoints.
+
+    Latency and error rate are exponentially weighted moving averages. The
+    error rate also decays with time, so an endpoint that failed gets traffic
+    again once it had time to recover. An endpoint with a connection error is
+    skipped for `cooldown` seconds, doubled on every further failure.
+    """
+
+    def __init__(self, urls, alpha=0.2, error_penalty=10.0,
+                 error_half_life=60.0, cooldown=5.0, max_cooldown=300.0):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.error_half_life = error_half_life
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._consecutive_failures = {}
+        self._lock = threading.Lock()
+
+    def _error_rate(self, endpoint, now):
+        age = now - endpoint.updated_at
+        return endpoint.error_rate * 0.5 ** (age / self.error_half_life)
+
+    def _score(self, endpoint, now):
+        # Unmeasured endpoints score as fast, so each one gets measured.
+        latency = endpoint.latency or 0.0
+        return latency * (1 + self.error_penalty * self._error_rate(endpoint, now))
+
+    def ranked(self):
+        """
+        Returns the endpoints from the healthiest, cooling down ones last
+        """
+        now = time.monotonic()
+        with self._lock:
+            return sorted(
+                self.endpoints,
+                key=lambda endpoint: (endpoint.unavailable_until > now,
+                                      self._score(endpoint, now)))
+
+    def _record(self, endpoint, elapsed, failed):
+        now = time.monotonic()
+        endpoint.requests += 1
+        endpoint.error_rate = (self.alpha * failed +
+                               (1 - self.alpha) * self._error_rate(endpoint, now))
+        endpoint.updated_at = now
+        if elapsed is not None:
+            endpoint.latency = elapsed if endpoint.latency is None else \
+                self.alpha * elapsed + (1 - self.alpha) * endpoint.latency
+
+    def record_response(self, endpoint, elapsed, failed=False):
+        """
+        Records a response, `failed` marks server errors
+        """
+        with self._lock:
+            self._record(endpoint, elapsed, failed)
+            if failed:
+                endpoint.failures += 1
+            self._consecutive_failures.pop(endpoint.url, None)
+            endpoint.unavailable_until = 0.0
+
+    def record_connection_error(self, endpoint):
+        """
+        Records a connection error and puts the endpoint on cooldown
+        """
+        with self._lock:
+            self._record(endpoint, None, True)
+            endpoint.failures += 1
+            failures = self._consecutive_failures.get(endpoint.url, 0) + 1
+            self._consecutive_failures[endpoint.url] = failures
+            endpoint.unavailable_until = time.monotonic() + min(
+                self.cooldown * 2 ** (failures - 1), self.max_cooldown)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'url': endpoint.url,
+                'latency': endpoint.latency,
+                'error_rate': self._error_rate(endpoint, now),
+                'requests': endpoint.requests,
+                'failures': endpoint.failures,
+                'available': endpoint.unavailable_until <= now,
+            } for endpoint in self.endpoints]
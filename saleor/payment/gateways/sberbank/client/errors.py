@@ -16,3 +16,13 @@ class ServerError(Exception):
 class SignatureVerificationError(Exception):
     def __init__(self, message=None, *args, **kwargs):
         super(SignatureVerificationError, self).__init__(message)
+
+
+class RateLimitError(Exception):
+    def __init__(self, message=None, *args, **kwargs):
+        super(RateLimitError, self).__init__(message)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, message=None, *args, **kwargs):
+        super(CircuitOpenError, self).__init__(message)
@@ -0,0 +1,73 @@
+import threading
+from collections import deque
+
+
+class ClientMetrics(object):
+    """
+    In-process counters for a single Sberbank client
+    """
+
+    LATENCY_WINDOW = 1000
+
+    def __init__(self, name=None):
+        self.name = name
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.total_time = 0.0
+        self.latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self.warm_up_time = None
+        self.endpoint = None
+        self.failovers = 0
+        self._lock = threading.Lock()
+
+    def request_started(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+
+    def request_finished(self, elapsed, failed=False):
+        with self._lock:
+            self.in_flight -= 1
+            self.total_time += elapsed
+            self.latencies.append(elapsed)
+            if failed:
+                self.errors += 1
+
+    def endpoint_chosen(self, url):
+        self.endpoint = url
+
+    def failover(self):
+        with self._lock:
+            self.failovers += 1
+
+    def warm_up_finished(self, elapsed):
+        self.warm_up_time = elapsed
+
+    @staticmethod
+    def _percentile(latencies, percent):
+        if not latencies:
+            return None
+        index = int(round(percent / 100.0 * (len(latencies) - 1)))
+        return latencies[index]
+
+    def snapshot(self):
+        """
+        Returns a plain dict with the current counters
+
+        Percentiles cover the last LATENCY_WINDOW requests.
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            return {
+                'name': self.name,
+                'requests': self.requests,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+                'total_time': self.total_time,
+                'warm_up_time': self.warm_up_time,
+                'endpoint': self.endpoint,
+                'failovers': self.failovers,
+                'p50': self._percentile(latencies, 50),
+                'p99': self._percentile(latencies, 99),
+            }
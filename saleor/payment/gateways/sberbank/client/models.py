@@ -0,0 +1,29 @@
+from collections import namedtuple
+
+from .constants import ORDER_STATUS
+
+
+class OrderStatus(namedtuple('OrderStatus',
+                             ['order_status', 'error_code', 'error_message'])):
+    """
+    Minimal order status returned by the status probe
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_response(cls, response):
+        order_status = response.get('OrderStatus', response.get('orderStatus'))
+        return cls(
+            order_status=None if order_status is None else int(order_status),
+            error_code=str(response.get('ErrorCode', response.get('errorCode', '0'))),
+            error_message=response.get('ErrorMessage', response.get('errorMessage')),
+        )
+
+    @property
+    def is_terminal(self):
+        return self.order_status in ORDER_STATUS.TERMINAL
+
+    @property
+    def is_paid(self):
+        return self.order_status in ORDER_STATUS.PAID
@@ -0,0 +1,100 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .circuit import CircuitBreaker
+from .client import Client
+from .metrics import ClientMetrics
+from .ratelimit import make_limiter
+
+DEFAULT_MAX_CONNECTIONS = 10
+
+
+class ClientPool(object):
+    """
+    Keeps one pooled Client per merchant account.
+
+    Every merchant gets its own requests session with a bounded connection
+    pool and its own metrics, so a slow merchant can only exhaust its own
+    connections.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(login, sandbox, max_connections, options):
+        return (login, bool(sandbox), max_connections,
+                tuple(sorted(options.items())))
+
+    @staticmethod
+    def _make_session(max_connections):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=max_connections,
+                              pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, login, password, sandbox=True,
+            max_connections=DEFAULT_MAX_CONNECTIONS,
+            rate_limit=None, rate_limit_redis_url=None, **options):
+        """
+        Returns the pooled client of the merchant, creating it on first use
+
+        A client built from outdated settings of the merchant is replaced and
+        its connections are closed.
+        """
+        key = self._make_key(login, sandbox, max_connections, dict(
+            options, rate_limit=rate_limit,
+            rate_limit_redis_url=rate_limit_redis_url))
+        client = self._clients.get(key)
+        if client is not None and client.auth == (login, password):
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None or client.auth != (login, password):
+                for stale_key in [other for other in self._clients
+                                  if other[:2] == key[:2]]:
+                    self._clients.pop(stale_key).session.close()
+                client = Client(session=self._make_session(max_connections),
+                                auth=(login, password),
+                                sandbox=sandbox,
+                                metrics=ClientMetrics(name=login),
+                                circuit=CircuitBreaker(),
+                                limiter=make_limiter(login, rate_limit,
+                                                     rate_limit_redis_url),
+                                **options)
+                self._clients[key] = client
+        return client
+
+    def clients(self):
+        return list(self._clients.values())
+
+    def stats(self):
+        """
+        Returns the metrics, pool size, circuit and endpoint state of every
+        merchant
+        """
+        stats = []
+        for client in self.clients():
+            adapter = client.session.get_adapter(client.base_url)
+            stats.append(dict(
+                client.metrics.snapshot(),
+                max_connections=getattr(adapter, '_pool_maxsize', None),
+                circuit=client.circuit.state if client.circuit else None,
+                endpoints=client.endpoints.snapshot()))
+        return stats
+
+    def clear(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.session.close()
+            self._clients = {}
+
+
+client_pool = ClientPool()
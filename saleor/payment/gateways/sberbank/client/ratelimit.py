@@ -0,0 +1,156 @@
+import threading
+import time
+
+from .constants import PRIORITY
+
+
+def clamp_reserve(capacity, reserve=None):
+    """
+    Returns the tokens kept for interactive requests
+
+    At least one token always stays available to background requests,
+    otherwise merchants with a low rate would starve them.
+    """
+    reserve = capacity / 2 if reserve is None else float(reserve)
+    return max(0.0, min(reserve, capacity - 1))
+
+
+class TokenBucket(object):
+    """
+    Process-local token bucket with priority classes.
+
+    Interactive requests may spend every token. Background requests may only
+    spend tokens above `reserve` and never while an interactive request is
+    waiting, so customer traffic always has headroom.
+    """
+
+    def __init__(self, rate, capacity=None, reserve=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(self.rate, 1))
+        self.reserve = clamp_reserve(self.capacity, reserve)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._waiting_interactive = 0
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _floor(self, priority):
+        return 0 if priority == PRIORITY.INTERACTIVE else self.reserve
+
+    def _can_take(self, priority):
+        if priority != PRIORITY.INTERACTIVE and self._waiting_interactive:
+            return False
+        return self._tokens - 1 >= self._floor(priority)
+
+    def acquire(self, priority=PRIORITY.INTERACTIVE, timeout=None):
+        """
+        Blocks until a token is available, returns False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interactive = priority == PRIORITY.INTERACTIVE
+
+        with self._condition:
+            if interactive:
+                self._waiting_interactive += 1
+            try:
+                while True:
+                    self._refill()
+                    if self._can_take(priority):
+                        self._tokens -= 1
+                        return True
+
+                    wait = max(self._floor(priority) + 1 - self._tokens,
+                               0.1) / self.rate
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        wait = min(wait, remaining)
+                    self._condition.wait(wait)
+            finally:
+                if interactive:
+                    self._waiting_interactive -= 1
+                    self._condition.notify_all()
+
+
+class RedisTokenBucket(object):
+    """
+    Token bucket shared by every process through Redis
+    """
+
+    SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local floor = tonumber(ARGV[4])
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(state[1]) or capacity
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+        local allowed = 0
+        if tokens - 1 >= floor then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return allowed
+    """
+
+    def __init__(self, redis_url, key, rate, capacity=None, reserve=None):
+        import redis
+
+        self.redis = redis.Redis.from_url(redis_url)
+        self.key = 'sberbank:ratelimit:{}'.format(key)
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(self.rate, 1))
+        self.reserve = clamp_reserve(self.capacity, reserve)
+        self._script = self.redis.register_script(self.SCRIPT)
+
+    def try_acquire(self, priority=PRIORITY.INTERACTIVE):
+        floor = 0 if priority == PRIORITY.INTERACTIVE else self.reserve
+        return bool(self._script(keys=[self.key],
+                                 args=[self.rate, self.capacity, time.time(), floor]))
+
+    def acquire(self, priority=PRIORITY.INTERACTIVE, timeout=None):
+        """
+        Polls Redis until a token is available, returns False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # Background callers back off longer so they poll Redis less often.
+        interval = (1 if priority == PRIORITY.INTERACTIVE else 2) / self.rate
+        while not self.try_acquire(priority):
+            if deadline is not None and time.monotonic() + interval > deadline:
+                return False
+            time.sleep(interval)
+        return True
+
+
+class LimiterChain(object):
+    """
+    Requires a token from every limiter, e.g. a local and a global one
+    """
+
+    def __init__(self, *limiters):
+        self.limiters = [limiter for limiter in limiters if limiter is not None]
+
+    def acquire(self, priority=PRIORITY.INTERACTIVE, timeout=None):
+        return all(limiter.acquire(priority, timeout)
+                   for limiter in self.limiters)
+
+
+def make_limiter(key, rate, redis_url=None):
+    """
+    Builds the limiter of a merchant, None when rate limiting is disabled
+    """
+    if not rate:
+        return None
+    local = TokenBucket(rate)
+    if not redis_url:
+        return local
+    return LimiterChain(local, RedisTokenBucket(redis_url, key, rate))
@@ -1,5 +1,11 @@
 from .payment import Payment
+from .deposit import Deposit
+from .refund import Refund
+from .reverse import Reverse
 
 __all__ = [
     'Payment',
+    'Deposit',
+    'Refund',
+    'Reverse',
 ]
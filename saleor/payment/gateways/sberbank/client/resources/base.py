@@ -19,6 +19,9 @@ class Resource(object):
     def post_url(self, url, data, **kwargs):
         return self.client.post(url, data, **kwargs)
 
+    async def apost_url(self, url, data, **kwargs):
+        return await self.client.apost(url, data, **kwargs)
+
     def put_url(self, url, data, **kwargs):
         return self.client.put(url, data, **kwargs)
 
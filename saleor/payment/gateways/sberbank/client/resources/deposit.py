@@ -0,0 +1,25 @@
+from .base import Resource
+from ..constants.url import URL
+
+
+class Deposit(Resource):
+    def __init__(self, client):
+        super(Deposit, self).__init__(client)
+        self.base_url = client.base_url
+
+    def create(self, order_id, amount=0, data=None, **kwargs):
+        """"
+        Capture the money of a two-stage payment
+
+        Args:
+            order_id : ID of the registered order in Sberbank
+            amount : Amount to capture, 0 captures the whole authorized amount
+
+        Returns:
+            errorCode and errorMessage of the operation
+        """
+        data = dict(data or {})
+        data['orderId'] = order_id
+        data['amount'] = amount
+
+        return self.post_url(URL.DEPOSIT_URL, data, **kwargs)
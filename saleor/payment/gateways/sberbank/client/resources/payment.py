@@ -1,5 +1,6 @@
 from .base import Resource
 from ..constants.url import URL
+from ..models import OrderStatus
 
 
 class Payment(Resource):
@@ -7,16 +8,16 @@ class Payment(Resource):
         super(Payment, self).__init__(client)
         self.base_url = client.base_url
 
-    def all(self, data={}, **kwargs):
+    def all(self, data=None, **kwargs):
         """"
         Fetch all Payment entities
 
         Returns:
             Dictionary of Payment data
         """
-        return super(Payment, self).all(data, **kwargs)
+        return super(Payment, self).all(dict(data or {}), **kwargs)
 
-    def register(self, order_id, amount, return_url, data={}, **kwargs):
+    def register(self, order_id, amount, return_url, data=None, **kwargs):
         """"
         Запрос  регистрации заказа в Сбербанке
 
@@ -28,13 +29,14 @@ class Payment(Resource):
             Payment form URL to redirect the client's browser to.
             :param data:
         """
+        data = dict(data or {})
         data['amount'] = amount
         data['orderNumber'] = "mymilavitsacom-" + str(order_id)
         data['returnUrl'] = return_url
 
         return self.post_url(URL.REGISTER_URL, data, **kwargs)
 
-    def get_status(self, order_id, data={}, **kwargs):
+    def get_status(self, order_id, data=None, **kwargs):
         """"
         Get payment status in Sberbank
 
@@ -44,6 +46,32 @@ class Payment(Resource):
         Returns:
             Order status in the payment system
         """
-
+        data = dict(data or {})
         data['orderNumber'] = "mymilavitsacom-" + str(order_id)
         return self.post_url(URL.STATUS_URL, data, **kwargs)
+
+    async def aget_status(self, order_id, data=None, **kwargs):
+        """"
+        Get payment status in Sberbank without blocking, see get_status
+        """
+        data = dict(data or {})
+        data['orderNumber'] = "mymilavitsacom-" + str(order_id)
+        return await self.apost_url(URL.STATUS_URL, data, **kwargs)
+
+    def probe_status(self, order_id, data=None, **kwargs):
+        """"
+        Lightweight status check of a registered order
+
+        Uses the minimal status endpoint, fetch the extended status with
+        get_status once the order reached a terminal state.
+
+        Args:
+            order_id : orderId returned by Sberbank on registration
+
+        Returns:
+            OrderStatus
+        """
+        data = dict(data or {})
+        data['orderId'] = order_id
+        return OrderStatus.from_response(
+            self.post_url(URL.STATUS_PROBE_URL, data, **kwargs))
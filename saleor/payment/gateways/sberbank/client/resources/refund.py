@@ -0,0 +1,25 @@
+from .base import Resource
+from ..constants.url import URL
+
+
+class Refund(Resource):
+    def __init__(self, client):
+        super(Refund, self).__init__(client)
+        self.base_url = client.base_url
+
+    def create(self, order_id, amount, data=None, **kwargs):
+        """"
+        Return money of a captured payment to the customer
+
+        Args:
+            order_id : ID of the registered order in Sberbank
+            amount : Amount to refund
+
+        Returns:
+            errorCode and errorMessage of the operation
+        """
+        data = dict(data or {})
+        data['orderId'] = order_id
+        data['amount'] = amount
+
+        return self.post_url(URL.REFUND_URL, data, **kwargs)
@@ -0,0 +1,26 @@
+from .base import Resource
+from ..constants.url import URL
+
+
+class Reverse(Resource):
+    def __init__(self, client):
+        super(Reverse, self).__init__(client)
+        self.base_url = client.base_url
+
+    def create(self, order_id, amount=None, data=None, **kwargs):
+        """"
+        Cancel an authorized but not captured payment
+
+        Args:
+            order_id : ID of the registered order in Sberbank
+            amount : Amount to release, the whole authorization when omitted
+
+        Returns:
+            errorCode and errorMessage of the operation
+        """
+        data = dict(data or {})
+        data['orderId'] = order_id
+        if amount is not None:
+            data['amount'] = amount
+
+        return self.post_url(URL.REVERSE_URL, data, **kwargs)
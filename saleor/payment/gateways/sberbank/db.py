@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Replication lag budget. Payments written within it are read from the primary.
+WRITE_PIN_TIMEOUT = 30
+
+
+def _get_written_key(payment_id):
+    return "sberbank:written:{}".format(payment_id)
+
+
+def get_replica_alias(connection_params):
+    """Return the configured read replica, the primary when there is none."""
+    alias = connection_params.get("replica_alias") or getattr(
+        settings, "DATABASE_CONNECTION_REPLICA_NAME", None
+    )
+    if not alias or alias not in connections.databases:
+        return DEFAULT_DB_ALIAS
+    return alias
+
+
+def mark_written(*payment_ids):
+    """Pin payments to the primary until the replica has their latest writes."""
+    cache.set_many(
+        {_get_written_key(payment_id): True for payment_id in payment_ids},
+        timeout=WRITE_PIN_TIMEOUT,
+    )
+
+
+def get_read_db(connection_params, payment_id=None):
+    """Return the database alias for a read-only lookup.
+
+    Reads stay on the primary inside a transaction and for payments written
+    recently, so a request never misses its own or a just finished write.
+    """
+    alias = get_replica_alias(connection_params)
+    if alias == DEFAULT_DB_ALIAS:
+        return alias
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return DEFAULT_DB_ALIAS
+    if payment_id is not None and cache.get(_get_written_key(payment_id)):
+        return DEFAULT_DB_ALIAS
+    return alias
@@ -0,0 +1,127 @@
+import logging
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from ... import TransactionKind
+from ...models import Payment, Transaction
+from .client import PRIORITY
+from .db import get_read_db, mark_written
+from .live_status import publish_status
+from .status import check_payment_status, get_pending_payments
+from .utils import (
+    OUTAGE_EXCEPTIONS,
+    get_channel_slug,
+    get_client,
+    get_order_id,
+    is_success_response,
+)
+
+logger = logging.getLogger(__name__)
+
+# Sberbank's default sessionTimeoutSecs, used when the plugin sets none.
+DEFAULT_SESSION_TIMEOUT = 1200
+# Margin for customers who opened the payment page at the last moment.
+EXPIRY_GRACE = timedelta(minutes=10)
+EXPIRY_CHUNK_SIZE = 500
+
+
+def get_session_timeout(connection_params):
+    return connection_params.get("session_timeout") or DEFAULT_SESSION_TIMEOUT
+
+
+def get_expired_payments(session_timeout):
+    cutoff = timezone.now() - timedelta(seconds=session_timeout) - EXPIRY_GRACE
+    return get_pending_payments().filter(created__lt=cutoff)
+
+
+def _deactivate(payment):
+    """Deactivate an expired payment and close its registration transaction."""
+    with transaction.atomic():
+        Payment.objects.filter(pk=payment.pk).update(
+            is_active=False, modified=timezone.now()
+        )
+        Transaction.objects.filter(
+            payment_id=payment.pk,
+            kind__in=[TransactionKind.AUTH, TransactionKind.CAPTURE],
+            action_required=True,
+        ).update(action_required=False, is_success=False, error="Payment expired")
+    mark_written(payment.pk)
+    publish_status(payment.pk)
+
+
+def _expire(payment, connection_params, reverse):
+    """Expire a payment that is still unpaid in Sberbank.
+
+    The payment is probed first, so an order paid without the customer coming
+    back is recorded instead of expired. Declined and reversed orders are only
+    deactivated. The payment is saved right after its reversal, an outage
+    later on never leaves a reversed order active. A payment whose reversal
+    Sberbank rejects stays active. Returns whether the payment expired.
+    """
+    order_id = get_order_id(payment)
+    status = check_payment_status(payment, connection_params, order_id=order_id)
+    if status is not None and status.is_terminal:
+        if status.is_paid:
+            return False
+    elif reverse and order_id:
+        client = get_client(
+            connection_params, get_channel_slug(payment.order or payment.checkout)
+        )
+        response = client.reverse.create(order_id=order_id, priority=PRIORITY.BACKGROUND)
+        if not is_success_response(response):
+            # Left active, so later notifications of the order still find it.
+            logger.warning(
+                "Sberbank rejected the reversal of expired payment %s: %s",
+                payment.pk,
+                response.get("errorMessage"),
+            )
+            return False
+    _deactivate(payment)
+    return True
+
+
+def expire_pending_payments(
+    connection_params,
+    session_timeout=None,
+    reverse=False,
+    chunk_size=EXPIRY_CHUNK_SIZE,
+    payments=None,
+):
+    """Deactivate registered payments that were never paid.
+
+    Runs in primary key chunks and keeps the pending set that pollers scan
+    small. Stops at the first outage, the rest is expired by the next run.
+    `payments` narrows the expired payments, e.g. to a shard.
+    """
+    if payments is None:
+        payments = get_expired_payments(
+            session_timeout or get_session_timeout(connection_params)
+        )
+    payments = payments.using(get_read_db(connection_params))
+    expired = 0
+    last_pk = 0
+    while True:
+        chunk = list(
+            payments.filter(pk__gt=last_pk)
+            .order_by("pk")
+            .select_related("order", "checkout")
+            .prefetch_related("transactions")[:chunk_size]
+        )
+        if not chunk:
+            break
+        for payment in chunk:
+            try:
+                expired += _expire(payment, connection_params, reverse)
+            except OUTAGE_EXCEPTIONS:
+                logger.warning("Sberbank is unavailable, expiry stopped")
+                break
+            except Exception:
+                logger.exception("Sberbank expiry of payment %s failed", payment.pk)
+        else:
+            last_pk = chunk[-1].pk
+            continue
+        break
+    logger.info("Expired %s unpaid Sberbank payments", expired)
+    return expired
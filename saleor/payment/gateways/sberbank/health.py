@@ -0,0 +1,99 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+
+from .client import CircuitBreaker, client_pool
+from .client.errors import BadRequestError, CircuitOpenError, RateLimitError
+from .utils import get_client
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROBE_INTERVAL = 30
+PROBE_TIMEOUT = 5
+PROBE_ORDER_ID = "00000000-0000-0000-0000-000000000000"
+PROBE_RESULT_KEY = "sberbank:health:probe"
+PROBE_LOCK_KEY = "sberbank:health:probe-lock"
+
+HEALTH_OK = "ok"
+HEALTH_DEGRADED = "degraded"
+HEALTH_UNAVAILABLE = "unavailable"
+
+
+def get_probe_interval():
+    return getattr(settings, "SBERBANK_HEALTH_PROBE_INTERVAL", DEFAULT_PROBE_INTERVAL)
+
+
+def run_probe(connection_params):
+    """Time a status request for an order that does not exist.
+
+    Sberbank answers it with HTTP 200 and an error code, or with a rejected
+    request, both prove the API is reachable. Any other failure counts as
+    down. The probe skips the merchant rate limit, so a scrape never waits
+    behind customer traffic. An open circuit is reported as not probed, the
+    circuit state itself marks the gateway degraded.
+    """
+    client = get_client(connection_params)
+    started = time.monotonic()
+    available, error = True, None
+    try:
+        client.payment.probe_status(
+            order_id=PROBE_ORDER_ID, rate_limited=False, timeout=PROBE_TIMEOUT
+        )
+    except (CircuitOpenError, RateLimitError) as exc:
+        available, error = None, exc.__class__.__name__
+    except BadRequestError:
+        pass
+    except Exception as exc:
+        available, error = False, exc.__class__.__name__
+    return {
+        "available": available,
+        "error": error,
+        "latency": time.monotonic() - started,
+        "checked_at": time.time(),
+    }
+
+
+def get_probe(connection_params):
+    """Return the latest probe result, running the probe at most once per interval.
+
+    The interval is enforced through the cache for every process, so the
+    health route can be scraped as often as needed.
+    """
+    interval = get_probe_interval()
+    if cache.add(PROBE_LOCK_KEY, True, timeout=interval):
+        result = run_probe(connection_params)
+        cache.set(PROBE_RESULT_KEY, result, timeout=interval * 5)
+        return result
+    return cache.get(PROBE_RESULT_KEY)
+
+
+def get_health(connection_params):
+    merchants = client_pool.stats()
+    for merchant in merchants:
+        # Logins of the merchants are not exposed.
+        merchant.pop("name", None)
+    probe = get_probe(connection_params)
+
+    if probe is not None and probe["available"] is False:
+        status = HEALTH_UNAVAILABLE
+    elif any(
+        merchant["circuit"] not in (None, CircuitBreaker.CLOSED) for merchant in merchants
+    ):
+        status = HEALTH_DEGRADED
+    else:
+        status = HEALTH_OK
+    return {"status": status, "probe": probe, "merchants": merchants}
+
+
+def handle_health(request, gateway_config):
+    """Report the gateway health of this process, 503 when Sberbank is down.
+
+    Pool and latency figures come from the clients of the serving process.
+    """
+    health = get_health(gateway_config.connection_params)
+    return JsonResponse(
+        health, status=503 if health["status"] == HEALTH_UNAVAILABLE else 200
+    )
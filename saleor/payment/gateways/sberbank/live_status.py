@@ -0,0 +1,167 @@
+import json
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponseNotFound, JsonResponse, StreamingHttpResponse
+from graphql_relay import from_global_id
+
+from ... import ChargeStatus
+from ...models import Payment
+from .db import get_read_db
+
+STATUS_VERSION_TIMEOUT = 60 * 60
+POLL_INTERVAL = 0.25
+DEFAULT_WAIT = 20
+MAX_WAIT = 25
+
+FINAL_CHARGE_STATUSES = {
+    ChargeStatus.FULLY_CHARGED,
+    ChargeStatus.PARTIALLY_REFUNDED,
+    ChargeStatus.FULLY_REFUNDED,
+    ChargeStatus.REFUSED,
+    ChargeStatus.CANCELLED,
+}
+
+
+def _get_version_key(payment_id):
+    return "sberbank:status-version:{}".format(payment_id)
+
+
+def publish_status(*payment_ids):
+    """Wake up the clients waiting for a state change of the payments.
+
+    Deferred until the current transaction commits, so woken clients never
+    read the state from before the change.
+    """
+    version = str(time.time())
+    transaction.on_commit(
+        lambda: cache.set_many(
+            {_get_version_key(payment_id): version for payment_id in payment_ids},
+            timeout=STATUS_VERSION_TIMEOUT,
+        )
+    )
+
+
+def get_status_version(payment_id):
+    return cache.get(_get_version_key(payment_id)) or "0"
+
+
+def wait_for_change(payment_id, since, timeout):
+    """Block until the status version differs from `since`.
+
+    Only the cache is polled while waiting, the database is not touched.
+    """
+    deadline = time.monotonic() + timeout
+    version = get_status_version(payment_id)
+    while version == since and time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        version = get_status_version(payment_id)
+    return version
+
+
+def _load_payment(payment_pk, connection_params):
+    return (
+        Payment.objects.using(get_read_db(connection_params, payment_pk))
+        .select_related("order", "checkout")
+        .prefetch_related("transactions")
+        .filter(pk=payment_pk, gateway="korolev.payments.sberbank")
+        .first()
+    )
+
+
+def _owns_payment(payment, checkout_token):
+    if payment.checkout and str(payment.checkout.token) == checkout_token:
+        return True
+    order_checkout_token = getattr(payment.order, "checkout_token", None)
+    return bool(order_checkout_token) and str(order_checkout_token) == checkout_token
+
+
+def get_status_payload(payment, version):
+    return {
+        "chargeStatus": payment.charge_status,
+        "isActive": payment.is_active,
+        "orderCreated": payment.order_id is not None,
+        "final": is_final(payment),
+        "version": version,
+    }
+
+
+def is_final(payment):
+    """Whether the payment state can no longer change for the customer.
+
+    A declined order leaves the payment active and not charged, but closes
+    its registration transaction like every terminal Sberbank status does.
+    """
+    if (
+        not payment.is_active
+        or payment.order_id is not None
+        or payment.charge_status in FINAL_CHARGE_STATUSES
+    ):
+        return True
+    transactions = payment.transactions.all()
+    return bool(transactions) and not any(txn.action_required for txn in transactions)
+
+
+def _stream_events(payment_pk, connection_params, since, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        version = wait_for_change(payment_pk, since, max(remaining, 0))
+        if version == since:
+            yield ": keep-alive\n\n"
+            return
+        payment = _load_payment(payment_pk, connection_params)
+        if payment is None:
+            return
+        yield "event: status\ndata: {}\n\n".format(
+            json.dumps(get_status_payload(payment, version))
+        )
+        if is_final(payment):
+            return
+        since = version
+
+
+def handle_status(request, gateway_config):
+    """Report the payment state once it changes, by long-poll or SSE.
+
+    Query parameters: `payment` (global ID), `checkout` (checkout token),
+    `since` (last seen version) and `timeout` in seconds. Responds at once
+    when the version differs from `since`, otherwise waits for a change.
+    """
+    payment_id = request.GET.get("payment")
+    checkout_token = request.GET.get("checkout")
+    if not payment_id or not checkout_token:
+        return HttpResponseNotFound()
+    try:
+        _type, payment_pk = from_global_id(payment_id)
+    except (UnicodeDecodeError, ValueError):
+        return HttpResponseNotFound()
+    if not payment_pk.isdigit():
+        return HttpResponseNotFound()
+
+    connection_params = gateway_config.connection_params
+    payment = _load_payment(payment_pk, connection_params)
+    if not payment or not _owns_payment(payment, checkout_token):
+        return HttpResponseNotFound()
+
+    since = request.GET.get("since") or ""
+    try:
+        timeout = min(float(request.GET.get("timeout", DEFAULT_WAIT)), MAX_WAIT)
+    except ValueError:
+        timeout = DEFAULT_WAIT
+
+    if "text/event-stream" in request.META.get("HTTP_ACCEPT", ""):
+        response = StreamingHttpResponse(
+            _stream_events(payment.pk, connection_params, since, timeout),
+            content_type="text/event-stream",
+        )
+        response["Cache-Control"] = "no-cache"
+        return response
+
+    version = get_status_version(payment.pk)
+    if version == since and not is_final(payment):
+        version = wait_for_change(payment.pk, since, timeout)
+        if version != since:
+            payment = _load_payment(payment.pk, connection_params)
+    return JsonResponse(get_status_payload(payment, version))
@@ -0,0 +1,296 @@
+import hashlib
+import hmac
+import logging
+from decimal import Decimal, InvalidOperation
+from itertools import groupby
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import graphene
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from graphql_relay import from_global_id
+
+from ...interface import GatewayConfig
+from ...models import Payment
+from .db import mark_written
+from .offline_queue import MAX_ATTEMPTS, OfflineQueue
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION = "notification"
+ORDER_NUMBER_PREFIX = "mymilavitsacom-"
+
+DEDUPLICATION_TIMEOUT = 24 * 60 * 60
+BATCH_SIZE = 500
+# Callbacks arriving within this window are handled as one batch.
+BATCH_WAIT = 1
+SCHEDULE_LOCK_KEY = "sberbank:notifications:scheduled"
+# Partial refunds of the same amount look alike, their handler reconciles
+# with Sberbank instead, so repeating it is harmless.
+RECONCILED_EVENTS = {"REFUND"}
+
+# Sberbank callback operation -> EVENT_MAP event for success and failure.
+OPERATION_EVENTS = {
+    "approved": ("AUTHORISATION", "AUTHORISATION"),
+    "deposited": ("CAPTURE", "CAPTURE_FAILED"),
+    "reversed": ("CANCELLATION", "CANCELLATION"),
+    "declinedByTimeout": ("CANCELLATION", "CANCELLATION"),
+    "refunded": ("REFUND", "REFUND_FAILED"),
+}
+
+
+def verify_checksum(params: Dict[str, str], token: str) -> bool:
+    """Check the HMAC-SHA256 checksum Sberbank signs callbacks with.
+
+    The signed string is every parameter but `checksum`, sorted by name, as
+    `name;value;` pairs.
+    """
+    checksum = params.get("checksum", "")
+    message = "".join(
+        "{};{};".format(name, value)
+        for name, value in sorted(params.items())
+        if name != "checksum"
+    )
+    expected = hmac.new(token.encode(), message.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected.upper(), checksum.upper())
+
+
+def parse_callback(params: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """Turn Sberbank callback parameters into an EVENT_MAP notification.
+
+    Returns None for unknown operations or orders not registered by Saleor.
+    """
+    events = OPERATION_EVENTS.get(params.get("operation"))
+    order_number = params.get("orderNumber", "")
+    if events is None or not order_number.startswith(ORDER_NUMBER_PREFIX):
+        return None
+    payment_pk = order_number[len(ORDER_NUMBER_PREFIX):]
+    if not payment_pk.isdigit():
+        return None
+
+    is_success = params.get("status") == "1"
+    notification = {
+        "eventCode": events[0] if is_success else events[1],
+        "pspReference": params.get("mdOrder"),
+        "merchantReference": graphene.Node.to_global_id("Payment", payment_pk),
+        "success": "true" if is_success else "false",
+        "operation": params.get("operation"),
+    }
+    try:
+        # Amounts come in kopecks and only with some operations.
+        notification["amount"] = {"value": str(Decimal(params["amount"]) / 100)}
+    except (KeyError, InvalidOperation):
+        pass
+    return notification
+
+
+def get_notification_key(notification: Dict[str, Any]) -> str:
+    return "sberbank:notification:{}:{}:{}:{}".format(
+        notification.get("pspReference"),
+        notification.get("eventCode"),
+        notification.get("success"),
+        notification.get("amount", {}).get("value"),
+    )
+
+
+def _get_db_payment_id(payment_id: Optional[str]) -> Optional[str]:
+    try:
+        _type, db_payment_id = from_global_id(payment_id or "")
+    except (UnicodeDecodeError, ValueError):
+        return None
+    return db_payment_id if db_payment_id.isdigit() else None
+
+
+def _claim(notifications):
+    """Drop notifications delivered more than once, within the batch or earlier.
+
+    Handled notifications are remembered in the cache once their transaction
+    commits, see `_handle_group`. Stored ones are deduplicated by the queue.
+    """
+    keys = [get_notification_key(notification) for notification in notifications]
+    handled = cache.get_many(keys)
+    claimed = {}
+    for key, notification in zip(keys, notifications):
+        if key in claimed:
+            continue
+        if notification.get("eventCode") in RECONCILED_EVENTS or key not in handled:
+            claimed[key] = notification
+    return claimed
+
+
+def _group(claimed) -> Dict[str, List[List[tuple]]]:
+    """Split notifications of every payment into runs of the same event.
+
+    Runs keep the arrival order, so handling them one after another preserves
+    the order within a payment.
+    """
+    by_payment: Dict[str, List[tuple]] = {}
+    for key, notification in claimed.items():
+        payment_id = _get_db_payment_id(notification.get("merchantReference"))
+        if payment_id is None:
+            logger.warning(
+                "Notification %s has no valid payment reference",
+                notification.get("pspReference"),
+            )
+            continue
+        by_payment.setdefault(payment_id, []).append((key, notification))
+    return {
+        payment_id: [
+            list(run)
+            for _, run in groupby(items, key=lambda item: item[1].get("eventCode"))
+        ]
+        for payment_id, items in by_payment.items()
+    }
+
+
+def _handle_group(event, runs, gateway_config):
+    """Handle one event type for many payments in a single transaction.
+
+    Payments are locked with one query and served to the handlers through
+    `prefetched_payments`. Returns the ids of payments whose handler failed.
+    """
+    from .webhooks import EVENT_MAP, prefetched_payments
+
+    handler = EVENT_MAP.get(event)
+    if handler is None:
+        logger.warning("Unknown Sberbank notification event %s", event)
+        return set()
+
+    failed = set()
+    with transaction.atomic():
+        payments = (
+            Payment.objects.select_for_update(of=("self",))
+            .prefetch_related("order", "checkout")
+            .filter(pk__in=runs, is_active=True, gateway="korolev.payments.sberbank")
+            .in_bulk()
+        )
+        token = prefetched_payments.set(
+            {payment_id: payments.get(int(payment_id)) for payment_id in runs}
+        )
+        try:
+            for payment_id, run in runs.items():
+                try:
+                    with transaction.atomic():
+                        for _, notification in run:
+                            handler(notification, gateway_config)
+                except Exception:
+                    logger.exception(
+                        "Sberbank %s notification of payment %s failed", event, payment_id
+                    )
+                    failed.add(payment_id)
+        finally:
+            prefetched_payments.reset(token)
+        if event not in RECONCILED_EVENTS:
+            handled_keys = [
+                key
+                for payment_id, run in runs.items()
+                if payment_id not in failed
+                for key, _ in run
+            ]
+            # Written only after the commit, a notification lost with a failed
+            # transaction or a dead worker is never taken for a duplicate.
+            transaction.on_commit(
+                lambda: cache.set_many(
+                    dict.fromkeys(handled_keys, True), timeout=DEDUPLICATION_TIMEOUT
+                )
+            )
+    mark_written(*[payment_id for payment_id in runs if payment_id not in failed])
+    return failed
+
+
+def process_notifications(
+    notifications: Iterable[Dict[str, Any]], gateway_config: GatewayConfig
+) -> Set[str]:
+    """Handle a batch of notifications through EVENT_MAP.
+
+    Every round takes the next run of each payment and handles the runs with
+    the same event type together. A payment whose handler fails is left out of
+    the following rounds and its notifications are retried by a later drain.
+    Returns the keys of the notifications that were not handled.
+    """
+    claimed = _claim(notifications)
+    runs = _group(claimed)
+
+    failed: set = set()
+    position = 0
+    while True:
+        by_event: Dict[str, Dict[str, List[tuple]]] = {}
+        for payment_id, payment_runs in runs.items():
+            if payment_id in failed or position >= len(payment_runs):
+                continue
+            run = payment_runs[position]
+            by_event.setdefault(run[0][1].get("eventCode"), {})[payment_id] = run
+        if not by_event:
+            break
+        for event, event_runs in by_event.items():
+            failed |= _handle_group(event, event_runs, gateway_config)
+        position += 1
+
+    return {
+        key for payment_id in failed for run in runs[payment_id] for key, _ in run
+    }
+
+
+def drain_notifications(gateway_config: GatewayConfig, batch_size: int = BATCH_SIZE):
+    """Handle parked notifications in arrival order, a batch at a time.
+
+    Failed notifications stay in the queue and are retried once their claim
+    times out. Returns the number of handled notifications.
+    """
+    queue = OfflineQueue()
+    handled = 0
+    while True:
+        entries = queue.claim(batch_size, kind=NOTIFICATION)
+        if not entries:
+            return handled
+        for entry_id, _, payload, attempts in entries:
+            if attempts >= MAX_ATTEMPTS:
+                logger.error(
+                    "Dropping Sberbank notification after %s attempts: %s",
+                    attempts,
+                    payload,
+                )
+                queue.done(entry_id)
+        entries = [entry for entry in entries if entry[3] < MAX_ATTEMPTS]
+        failed_keys = process_notifications(
+            [payload for _, _, payload, _ in entries], gateway_config
+        )
+        for entry_id, _, payload, _ in entries:
+            if get_notification_key(payload) in failed_keys:
+                queue.fail(entry_id)
+            else:
+                queue.done(entry_id)
+                handled += 1
+
+
+def schedule_drain():
+    """Start a drain shortly, once for all callbacks of the burst."""
+    from .tasks import process_sberbank_notifications_task
+
+    if cache.add(SCHEDULE_LOCK_KEY, True, timeout=BATCH_WAIT):
+        transaction.on_commit(
+            lambda: process_sberbank_notifications_task.apply_async(countdown=BATCH_WAIT)
+        )
+
+
+def handle_callback(request, gateway_config: GatewayConfig):
+    """Accept a Sberbank callback.
+
+    The notification is stored in the database before Sberbank gets 200, so
+    an acknowledged callback is never lost. It is handled by the next drain.
+    """
+    params = request.GET.dict()
+    token = gateway_config.connection_params.get("callback_token")
+    if not token:
+        # Unsigned callbacks could be forged by anyone knowing the order.
+        logger.warning("Sberbank callback rejected, no callback token configured")
+        return HttpResponseForbidden()
+    if not verify_checksum(params, token):
+        return HttpResponseForbidden()
+    notification = parse_callback(params)
+    if notification is None:
+        return HttpResponseBadRequest()
+    OfflineQueue().park(NOTIFICATION, get_notification_key(notification), notification)
+    schedule_drain()
+    return HttpResponse("OK")
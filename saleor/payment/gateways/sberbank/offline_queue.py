@@ -0,0 +1,212 @@
+import json
+import logging
+import time
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from ...models import Payment
+from .status import check_payment_status
+from .utils import OUTAGE_EXCEPTIONS
+
+logger = logging.getLogger(__name__)
+
+STATUS_CHECK = "status"
+
+# How long a claimed entry stays invisible to other drainers.
+CLAIM_TIMEOUT = 300
+# Entries failing for other reasons than an outage are dropped after that.
+MAX_ATTEMPTS = 20
+# Checkouts waiting for the customer to finish paying are checked this often.
+RETRY_DELAY = 60
+
+TABLE = "sberbank_offline_queue"
+
+
+class OfflineQueue:
+    """Durable queue of work parked while Sberbank is unavailable.
+
+    Entries live in a table of the main database, so the web processes that
+    park work and the Celery workers that drain it share them on any host.
+    Each entry has a unique key, parking the same work twice keeps one entry.
+    The plugin is not a Django app, so the table is created on first use.
+    """
+
+    _created = set()
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        if using not in self._created:
+            with connections[using].cursor() as cursor:
+                cursor.execute(
+                    "CREATE TABLE IF NOT EXISTS {} ("
+                    " id BIGSERIAL PRIMARY KEY,"
+                    " kind TEXT NOT NULL,"
+                    " key TEXT NOT NULL UNIQUE,"
+                    " payload TEXT NOT NULL,"
+                    " attempts INTEGER NOT NULL DEFAULT 0,"
+                    " available_at DOUBLE PRECISION NOT NULL)".format(TABLE)
+                )
+            self._created.add(using)
+
+    def _cursor(self):
+        return connections[self.using].cursor()
+
+    def park(self, kind, key, payload):
+        with self._cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO {} (kind, key, payload, available_at)"
+                " VALUES (%s, %s, %s, %s) ON CONFLICT (key) DO NOTHING".format(TABLE),
+                [kind, key, json.dumps(payload), time.time()],
+            )
+
+    def claim(self, limit, kind):
+        """Take up to `limit` ready entries of the kind, oldest first.
+
+        Entries locked by a concurrent drainer are skipped.
+        """
+        now = time.time()
+        with transaction.atomic(using=self.using), self._cursor() as cursor:
+            cursor.execute(
+                "SELECT id, kind, payload, attempts FROM {}"
+                " WHERE kind = %s AND available_at <= %s"
+                " ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED".format(TABLE),
+                [kind, now, limit],
+            )
+            rows = cursor.fetchall()
+            if rows:
+                cursor.execute(
+                    "UPDATE {} SET available_at = %s WHERE id IN ({})".format(
+                        TABLE, ", ".join(["%s"] * len(rows))
+                    ),
+                    [now + CLAIM_TIMEOUT] + [row[0] for row in rows],
+                )
+        return [(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+    def done(self, entry_id):
+        with self._cursor() as cursor:
+            cursor.execute("DELETE FROM {} WHERE id = %s".format(TABLE), [entry_id])
+
+    def fail(self, entry_id):
+        """Count a failed attempt, the entry is retried once the claim times out.
+
+        Outages are not counted, see release.
+        """
+        with self._cursor() as cursor:
+            cursor.execute(
+                "UPDATE {} SET attempts = attempts + 1 WHERE id = %s".format(TABLE),
+                [entry_id],
+            )
+
+    def postpone(self, entry_id, delay):
+        """Retry a claimed entry after `delay` seconds, without counting an attempt."""
+        with self._cursor() as cursor:
+            cursor.execute(
+                "UPDATE {} SET available_at = %s WHERE id = %s".format(TABLE),
+                [time.time() + delay, entry_id],
+            )
+
+    def release(self, entry_ids):
+        """Make claimed entries available again without waiting for timeout."""
+        if not entry_ids:
+            return
+        with self._cursor() as cursor:
+            cursor.execute(
+                "UPDATE {} SET available_at = %s WHERE id IN ({})".format(
+                    TABLE, ", ".join(["%s"] * len(entry_ids))
+                ),
+                [time.time()] + list(entry_ids),
+            )
+
+    def __len__(self):
+        with self._cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM {}".format(TABLE))
+            return cursor.fetchone()[0]
+
+
+def park_status_check(payment_id, order_id, complete_checkout=False):
+    """Park a status check, optionally finishing the checkout once paid.
+
+    Keyed by the payment, the order id may still be unknown and is then
+    looked up when the check runs.
+    """
+    OfflineQueue().park(
+        STATUS_CHECK,
+        "{}:{}".format(STATUS_CHECK, payment_id),
+        {
+            "payment_id": payment_id,
+            "order_id": order_id,
+            "complete_checkout": complete_checkout,
+        },
+    )
+    logger.warning(
+        "Sberbank is unavailable, status check of payment %s parked", payment_id
+    )
+
+
+def _drain_status_check(payload, connection_params):
+    """Check a parked payment, returns False while it has to be checked again.
+
+    A checkout parked by the redirect handler stays in the queue until the
+    order is final, the status sweep never creates orders.
+    """
+    payment = Payment.objects.filter(pk=payload["payment_id"]).first()
+    if payment is None or not payment.is_active:
+        return True
+    status = check_payment_status(payment, connection_params, order_id=payload["order_id"])
+    if not payload.get("complete_checkout") or status is None:
+        return True
+    if not status.is_terminal:
+        return False
+    if not status.is_paid:
+        return True
+
+    # The customer came back while Sberbank was down, the order is created
+    # here instead of in the redirect handler.
+    from .webhooks import create_order, get_checkout
+
+    with transaction.atomic():
+        payment = Payment.objects.select_for_update().get(pk=payment.pk)
+        if payment.order_id:
+            return True
+        checkout = get_checkout(payment)
+        if checkout:
+            create_order(payment, checkout)
+    return True
+
+
+def drain(connection_params, batch_size=100, rate=1.0):
+    """Process parked work at `rate` entries per second.
+
+    Stops at the first outage error, returning the rest of the batch to the
+    queue, so a gateway that is still down costs a single request.
+    """
+    queue = OfflineQueue()
+    entries = queue.claim(batch_size, STATUS_CHECK)
+    processed = 0
+    for index, (entry_id, kind, payload, attempts) in enumerate(entries):
+        if index:
+            time.sleep(1 / rate)
+        if attempts >= MAX_ATTEMPTS:
+            # Only failures other than outages are counted, so a long outage
+            # never drops parked work.
+            logger.error("Dropping parked Sberbank %s after %s attempts: %s",
+                         kind, attempts, payload)
+            queue.done(entry_id)
+            continue
+        try:
+            finished = _drain_status_check(payload, connection_params)
+        except OUTAGE_EXCEPTIONS:
+            queue.release([entry[0] for entry in entries[index:]])
+            logger.info("Sberbank is still unavailable, draining stopped")
+            break
+        except Exception:
+            # Left claimed, the entry is retried once the claim times out.
+            logger.exception("Parked Sberbank %s failed: %s", kind, payload)
+            queue.fail(entry_id)
+            continue
+        if not finished:
+            queue.postpone(entry_id, RETRY_DELAY)
+            continue
+        queue.done(entry_id)
+        processed += 1
+    return processed
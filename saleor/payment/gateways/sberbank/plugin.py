@@ -1,19 +1,37 @@
+from functools import lru_cache
+from typing import List, Tuple
+
 from saleor.plugins.base_plugin import BasePlugin, ConfigurationTypeField
+from django.core.exceptions import ValidationError
 from django.utils.translation import pgettext_lazy
 
 from ..utils import get_supported_currencies
-from . import (GatewayConfig,
-               confirm_payment,
-               process_payment,
-               )
+from ...interface import GatewayConfig
+from .client.pool import DEFAULT_MAX_CONNECTIONS
+from .profiling import profiled
+from .receipt import DEFAULT_VAT_RATE, get_tax
+from .utils import parse_channel_merchants, parse_endpoints, parse_number
 
 from django.core.handlers.wsgi import WSGIRequest
 from django.http import HttpResponse, HttpResponseNotFound
 
-from .webhooks import handle_additional_actions
-
 GATEWAY_NAME = "Sberbank"
 ADDITIONAL_ACTION_PATH = "/additional-actions"
+STATUS_PATH = "/status"
+HEALTH_PATH = "/health"
+CALLBACK_PATH = "/callback"
+
+
+# Settings entered as text but read as numbers, with the type they must parse to.
+NUMBER_FIELDS = {
+    "Max connections per merchant": int,
+    "Requests per second per merchant": float,
+    "Warm-up connections": int,
+    "Session timeout": int,
+    "Tax system": int,
+    "Profiling sample rate": float,
+    "Profiling max size (MB)": float,
+}
 
 
 def require_active_plugin(fn):
@@ -26,6 +44,56 @@ def require_active_plugin(fn):
     return wrapped
 
 
+@lru_cache(maxsize=32)
+def get_cached_gateway_config(configuration_version: Tuple) -> Tuple[GatewayConfig, List[str]]:
+    """Build the gateway config and the list of supported currencies.
+
+    The configuration version is the tuple of saved (name, value) pairs, so any
+    change made in the dashboard produces a new cache key.
+    """
+    configuration = dict(configuration_version)
+    config = GatewayConfig(
+        gateway_name=GATEWAY_NAME,
+        auto_capture=configuration["Automatic payment capture"],
+        supported_currencies=configuration["Supported currencies"],
+        connection_params={
+            "sandbox_mode": configuration["Use sandbox"],
+            "login": configuration["Login"],
+            "password": configuration["Password"],
+            "merchants": parse_channel_merchants(configuration.get("Channel merchants")),
+            "max_connections": parse_number(
+                configuration.get("Max connections per merchant"), int, DEFAULT_MAX_CONNECTIONS
+            ),
+            "rate_limit": parse_number(
+                configuration.get("Requests per second per merchant"), float, 0
+            ),
+            "rate_limit_redis_url": configuration.get("Rate limit Redis URL") or None,
+            "endpoints": parse_endpoints(configuration.get("Alternate endpoints")),
+            "callback_token": configuration.get("Callback token") or None,
+            "warm_up_connections": parse_number(
+                configuration.get("Warm-up connections"), int, 0
+            ),
+            "session_timeout": parse_number(
+                configuration.get("Session timeout"), int, 0
+            ) or None,
+            "reverse_expired": bool(configuration.get("Reverse expired payments")),
+            "replica_alias": configuration.get("Read replica database alias") or None,
+            "send_receipt": bool(configuration.get("Send fiscal receipt")),
+            "tax_system": parse_number(configuration.get("Tax system"), int, 0),
+            "vat_rate": configuration.get("Default VAT rate") or "20",
+            "profiling_rate": parse_number(
+                configuration.get("Profiling sample rate"), float, 0
+            ),
+            "profiling_directory": configuration.get("Profiling directory") or "sberbank-profiles",
+            "profiling_max_bytes": int(
+                parse_number(configuration.get("Profiling max size (MB)"), float, 100)
+                * 1024 * 1024
+            ),
+        },
+    )
+    return config, get_supported_currencies(config, GATEWAY_NAME)
+
+
 class SberbankGatewayPlugin(BasePlugin):
     PLUGIN_NAME = GATEWAY_NAME
     PLUGIN_ID = "korolev.payments.sberbank"
@@ -36,6 +104,22 @@ class SberbankGatewayPlugin(BasePlugin):
         {"name": "Use sandbox", "value": True},
         {"name": "Automatic payment capture", "value": False},
         {"name": "Supported currencies", "value": "RUB"},
+        {"name": "Channel merchants", "value": ""},
+        {"name": "Max connections per merchant", "value": str(DEFAULT_MAX_CONNECTIONS)},
+        {"name": "Requests per second per merchant", "value": ""},
+        {"name": "Rate limit Redis URL", "value": ""},
+        {"name": "Alternate endpoints", "value": ""},
+        {"name": "Callback token", "value": ""},
+        {"name": "Warm-up connections", "value": "0"},
+        {"name": "Session timeout", "value": ""},
+        {"name": "Reverse expired payments", "value": False},
+        {"name": "Read replica database alias", "value": ""},
+        {"name": "Send fiscal receipt", "value": False},
+        {"name": "Tax system", "value": "0"},
+        {"name": "Default VAT rate", "value": "20"},
+        {"name": "Profiling sample rate", "value": ""},
+        {"name": "Profiling directory", "value": "sberbank-profiles"},
+        {"name": "Profiling max size (MB)", "value": "100"},
     ]
 
     CONFIG_STRUCTURE = {
@@ -78,41 +162,190 @@ class SberbankGatewayPlugin(BasePlugin):
                          " Please enter currency codes separated by a comma.",
             "label": "Supported currencies",
         },
+        "Channel merchants": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Merchant credentials of the sales channels."
+                         " Please enter channel-slug:login:password entries"
+                         " separated by a comma. Channels without an entry"
+                         " use the default login and password.",
+            "label": "Channel merchants",
+        },
+        "Max connections per merchant": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Maximum number of open connections to Sberbank API"
+                         " kept for each merchant.",
+            "label": "Max connections per merchant",
+        },
+        "Requests per second per merchant": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Limits calls to Sberbank API for each merchant."
+                         " Customer requests always go ahead of background"
+                         " jobs. Leave empty to disable the limit.",
+            "label": "Requests per second per merchant",
+        },
+        "Rate limit Redis URL": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Redis used to share the rate limit between all"
+                         " processes. Leave empty to limit each process on"
+                         " its own.",
+            "label": "Rate limit Redis URL",
+        },
+        "Alternate endpoints": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Base URLs equivalent to the Sberbank API, e.g."
+                         " alternate hosts or a regional proxy, separated by a"
+                         " comma. Requests go to the fastest healthy one and"
+                         " fail over on connection errors.",
+            "label": "Alternate endpoints",
+        },
+        "Callback token": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Key Sberbank signs callbacks with. Callbacks without"
+                         " a valid checksum, or all of them while it is"
+                         " empty, are rejected.",
+            "label": "Callback token",
+        },
+        "Warm-up connections": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Number of keep-alive connections each new worker"
+                         " opens to Sberbank API on start. 0 disables"
+                         " the warm-up.",
+            "label": "Warm-up connections",
+        },
+        "Session timeout": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Seconds a customer has to pay a registered order."
+                         " Unpaid payments are expired after it. Leave empty"
+                         " to use the Sberbank default of 1200 seconds.",
+            "label": "Session timeout",
+        },
+        "Reverse expired payments": {
+            "type": ConfigurationTypeField.BOOLEAN,
+            "help_text": "Determines if expired payments are also cancelled"
+                         " in Sberbank with reverse.do.",
+            "label": "Reverse expired payments",
+        },
+        "Read replica database alias": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Database alias used for read-only lookups of the"
+                         " gateway. Leave empty to use the replica from"
+                         " DATABASE_CONNECTION_REPLICA_NAME, if configured.",
+            "label": "Read replica database alias",
+        },
+        "Send fiscal receipt": {
+            "type": ConfigurationTypeField.BOOLEAN,
+            "help_text": "Determines if the 54-FZ receipt (orderBundle) is"
+                         " sent with the order registration.",
+            "label": "Send fiscal receipt",
+        },
+        "Tax system": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Sberbank taxSystem code of the merchant: 0 general,"
+                         " 1 simplified income, 2 simplified income minus"
+                         " expense, 3 UTII, 4 UAT, 5 patent.",
+            "label": "Tax system",
+        },
+        "Default VAT rate": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "VAT rate of receipt items: 0, 10 or 20. Product types"
+                         " can override it with the sberbank.vat metadata key.",
+            "label": "Default VAT rate",
+        },
+        "Profiling sample rate": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Fraction of process_payment, confirm_payment and"
+                         " webhook calls to profile, e.g. 0.01. Leave empty"
+                         " to disable profiling.",
+            "label": "Profiling sample rate",
+        },
+        "Profiling directory": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Directory where profiles are saved in the"
+                         " speedscope format.",
+            "label": "Profiling directory",
+        },
+        "Profiling max size (MB)": {
+            "type": ConfigurationTypeField.STRING,
+            "help_text": "Oldest profiles are removed once the directory"
+                         " grows over this size.",
+            "label": "Profiling max size (MB)",
+        },
     }
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        configuration = {item["name"]: item["value"] for item in self.configuration}
-        self.config = GatewayConfig(
-            gateway_name=GATEWAY_NAME,
-            auto_capture=configuration["Automatic payment capture"],
-            supported_currencies=configuration["Supported currencies"],
-            connection_params={
-                "sandbox_mode": configuration["Use sandbox"],
-                "login": configuration["Login"],
-                "password": configuration["Password"]
-            },
+        configuration_version = tuple(
+            (item["name"], item["value"]) for item in self.configuration
         )
+        self.config, self.supported_currencies = get_cached_gateway_config(
+            configuration_version
+        )
+
+    @classmethod
+    def validate_plugin_configuration(cls, plugin_configuration):
+        """Reject values the gateway config could not be built from."""
+        configuration = {
+            item["name"]: item["value"] for item in plugin_configuration.configuration
+        }
+        errors = {}
+        for name, cast in NUMBER_FIELDS.items():
+            value = configuration.get(name)
+            if value in (None, ""):
+                continue
+            try:
+                if cast(value) < 0:
+                    raise ValueError(value)
+            except (TypeError, ValueError):
+                errors[name] = ValidationError("Enter a non-negative number.")
+        try:
+            get_tax(configuration.get("Default VAT rate") or DEFAULT_VAT_RATE)
+        except ValueError:
+            errors["Default VAT rate"] = ValidationError("Enter 0, 10 or 20.")
+        try:
+            parse_channel_merchants(configuration.get("Channel merchants"), strict=True)
+        except ValueError as e:
+            errors["Channel merchants"] = ValidationError(
+                "Malformed entry %(entry)s, use channel-slug:login:password.",
+                params={"entry": e.args[0]},
+            )
+        if errors:
+            raise ValidationError(errors)
+
+    @classmethod
+    def save_plugin_configuration(cls, plugin_configuration, cleaned_data):
+        plugin_configuration = super().save_plugin_configuration(
+            plugin_configuration, cleaned_data
+        )
+        get_cached_gateway_config.cache_clear()
+        return plugin_configuration
 
     def _get_gateway_config(self) -> GatewayConfig:
         return self.config
 
     @require_active_plugin
     def get_supported_currencies(self, previous_value):
-        config = self._get_gateway_config()
-        return get_supported_currencies(config, GATEWAY_NAME)
+        return list(self.supported_currencies)
 
     @require_active_plugin
     def process_payment(
             self, payment_information: "PaymentData", previous_value
     ) -> "GatewayResponse":
-        return process_payment(self, payment_information, self._get_gateway_config())
+        from . import process_payment
+
+        config = self._get_gateway_config()
+        with profiled(config.connection_params, "process_payment",
+                      payment_information.payment_id):
+            return process_payment(self, payment_information, config)
 
     @require_active_plugin
     def confirm_payment(
             self, payment_information: "PaymentData", previous_value
     ) -> "GatewayResponse":
-        return confirm_payment(self, payment_information, previous_value)
+        from . import confirm_payment
+
+        with profiled(self.config.connection_params, "confirm_payment",
+                      payment_information.payment_id):
+            return confirm_payment(self, payment_information, previous_value)
 
     @require_active_plugin
     def token_is_required_as_payment_input(self, previous_value):
@@ -120,8 +353,28 @@ class SberbankGatewayPlugin(BasePlugin):
 
     def webhook(self, request: WSGIRequest, path: str, previous_value) -> HttpResponse:
         config = self._get_gateway_config()
+        with profiled(config.connection_params, "webhook", request.GET.get("payment")):
+            return self._handle_webhook(request, path, config)
+
+    def _handle_webhook(self, request: WSGIRequest, path: str, config) -> HttpResponse:
         if path.startswith(ADDITIONAL_ACTION_PATH):
+            # Webhooks pull in the checkout and order machinery, which is
+            # only loaded by processes that actually serve a webhook.
+            from .webhooks import handle_additional_actions
+
             return handle_additional_actions(
                 request, config
             )
+        if path.startswith(STATUS_PATH):
+            from .live_status import handle_status
+
+            return handle_status(request, config)
+        if path.startswith(CALLBACK_PATH):
+            from .notifications import handle_callback
+
+            return handle_callback(request, config)
+        if path.startswith(HEALTH_PATH):
+            from .health import handle_health
+
+            return handle_health(request, config)
         return HttpResponseNotFound()
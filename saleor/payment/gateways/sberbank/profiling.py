@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.005
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread from a background thread.
+
+    The profiled code runs untouched, the cost is one stack walk every
+    `interval` seconds. Results are exported in the speedscope format.
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.frames = []
+        self.frame_index = {}
+        self.samples = []
+        self.weights = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _frame_id(self, code, line):
+        key = (code.co_name, code.co_filename, line)
+        index = self.frame_index.get(key)
+        if index is None:
+            index = self.frame_index[key] = len(self.frames)
+            self.frames.append({"name": key[0], "file": key[1], "line": key[2]})
+        return index
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_id(frame.f_code, frame.f_lineno))
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append(stack)
+            self.weights.append(now - last)
+            last = now
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self.started
+
+    def to_speedscope(self, name):
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": name,
+            "exporter": "saleor-sberbank-gateway",
+            "shared": {"frames": self.frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": self.duration,
+                    "samples": self.samples,
+                    "weights": self.weights,
+                }
+            ],
+        }
+
+
+def rotate(directory, max_bytes):
+    """Remove the oldest profiles until the directory fits in `max_bytes`."""
+    entries = [entry for entry in os.scandir(directory) if entry.is_file()]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+
+
+def _save(profiler, endpoint, payment_id, directory, max_bytes):
+    payment_tag = re.sub(r"[^A-Za-z0-9_-]", "", str(payment_id or "none"))
+    name = "{}-{}-{}".format(endpoint, payment_tag, int(time.time() * 1000))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name + ".speedscope.json")
+    with open(path, "w") as profile_file:
+        json.dump(profiler.to_speedscope(name), profile_file)
+    rotate(directory, max_bytes)
+
+
+@contextmanager
+def profiled(connection_params, endpoint, payment_id=None):
+    """Profile a sampled fraction of calls of a gateway endpoint.
+
+    Profiles are tagged with the endpoint and payment id in the file name.
+    Profiling never breaks the call, failures to save are only logged.
+    """
+    rate = connection_params.get("profiling_rate")
+    if not rate or random.random() >= rate:
+        yield
+        return
+
+    profiler = SamplingProfiler(threading.get_ident())
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        try:
+            _save(
+                profiler,
+                endpoint,
+                payment_id,
+                connection_params["profiling_directory"],
+                connection_params["profiling_max_bytes"],
+            )
+        except OSError:
+            logger.exception("Unable to save the Sberbank gateway profile")
@@ -0,0 +1,187 @@
+import json
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+from .utils import get_amount_for_sberbank
+
+# Sberbank taxType codes of the VAT rates.
+VAT_TAX_TYPES = {
+    None: 0,
+    Decimal("0"): 1,
+    Decimal("10"): 2,
+    Decimal("20"): 6,
+}
+DEFAULT_VAT_RATE = "20"
+VAT_METADATA_KEY = "sberbank.vat"
+MEASURE = "шт"
+# 54-FZ paymentMethod 1 is full prepayment, paymentObject 1 goods, 4 a service.
+FULL_PREPAYMENT = "1"
+GOODS = "1"
+SERVICE = "4"
+
+# Built once, encoding a bundle then needs no per-call setup.
+_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+@lru_cache(maxsize=64)
+def get_tax(vat_rate):
+    """Return the shared `tax` object of a VAT rate, None means no VAT."""
+    try:
+        rate = None if vat_rate in (None, "") else Decimal(str(vat_rate)).normalize()
+    except InvalidOperation:
+        rate = vat_rate
+    if rate is not None and rate not in VAT_TAX_TYPES:
+        raise ValueError("Unsupported VAT rate for Sberbank receipt: %s" % vat_rate)
+    return {"taxType": VAT_TAX_TYPES[rate]}
+
+
+def _get_item_attributes(payment_object):
+    return {
+        "attributes": [
+            {"name": "paymentMethod", "value": FULL_PREPAYMENT},
+            {"name": "paymentObject", "value": payment_object},
+        ]
+    }
+
+
+# Shared by every item, like the tax objects.
+GOODS_ATTRIBUTES = _get_item_attributes(GOODS)
+SERVICE_ATTRIBUTES = _get_item_attributes(SERVICE)
+
+
+def _get_product_type_tax(product_type, default_vat_rate):
+    """VAT rate of a product type, set in its metadata under `sberbank.vat`."""
+    if not product_type.charge_taxes:
+        return get_tax(None)
+    return get_tax(
+        product_type.get_value_from_metadata(VAT_METADATA_KEY, default_vat_rate)
+    )
+
+
+def _fit_to_total(amounts, total):
+    """Spread the difference to the payment total over the items.
+
+    Discounts and rounding make the line sum differ from the charged amount,
+    which Sberbank rejects. The difference is split proportionally and the
+    rest of the division goes to the largest item.
+    """
+    current = sum(amounts)
+    if current == total or not current:
+        return amounts
+    difference = total - current
+    fitted = [amount + difference * amount // current for amount in amounts]
+    largest = max(range(len(fitted)), key=fitted.__getitem__)
+    fitted[largest] += total - sum(fitted)
+    return fitted
+
+
+def _split_by_price(item, amount):
+    """Give the item a whole itemPrice in kopecks, splitting it when needed.
+
+    A fitted amount not divisible by the quantity becomes two items, the
+    units at the lower price and the rest one kopeck more, so
+    itemPrice * quantity always equals itemAmount.
+    """
+    quantity = item["quantity"]["value"]
+    price, rest = divmod(amount, quantity)
+    if not rest:
+        return [dict(item, itemPrice=price, itemAmount=amount)]
+    return [
+        dict(
+            item,
+            quantity={"value": quantity - rest, "measure": MEASURE},
+            itemPrice=price,
+            itemAmount=price * (quantity - rest),
+        ),
+        dict(
+            item,
+            # itemCode has to be unique within the bundle.
+            itemCode="{}-2".format(item["itemCode"]),
+            quantity={"value": rest, "measure": MEASURE},
+            itemPrice=price + 1,
+            itemAmount=(price + 1) * rest,
+        ),
+    ]
+
+
+def build_order_bundle(lines, total, email=None, shipping=None, default_vat_rate=DEFAULT_VAT_RATE):
+    """Serialize the orderBundle of register.do.
+
+    `lines` are (name, code, quantity, unit price, product type) tuples,
+    `shipping` an optional (name, price) pair and `total` the charged amount.
+    Item amounts are fitted to the total first, itemPrice is the fitted price
+    of a unit.
+    """
+    items = []
+    amounts = []
+    product_type_taxes = {}
+    for name, code, quantity, unit_price, product_type in lines:
+        tax = product_type_taxes.get(product_type.pk)
+        if tax is None:
+            tax = product_type_taxes[product_type.pk] = _get_product_type_tax(
+                product_type, default_vat_rate
+            )
+        amounts.append(get_amount_for_sberbank(unit_price * quantity))
+        items.append(
+            {
+                "name": name[:100],
+                "quantity": {"value": quantity, "measure": MEASURE},
+                "itemCode": code,
+                "tax": tax,
+                "itemAttributes": GOODS_ATTRIBUTES,
+            }
+        )
+    if shipping is not None:
+        name, price = shipping
+        amounts.append(get_amount_for_sberbank(price))
+        items.append(
+            {
+                "name": name[:100],
+                "quantity": {"value": 1, "measure": MEASURE},
+                "itemCode": "shipping",
+                "tax": get_tax(default_vat_rate),
+                "itemAttributes": SERVICE_ATTRIBUTES,
+            }
+        )
+
+    fitted = _fit_to_total(amounts, get_amount_for_sberbank(total))
+    items = [
+        dict(part, positionId=position)
+        for position, part in enumerate(
+            (
+                part
+                for item, amount in zip(items, fitted)
+                for part in _split_by_price(item, amount)
+            ),
+            1,
+        )
+    ]
+
+    bundle = {"cartItems": {"items": items}}
+    if email:
+        bundle["customerDetails"] = {"email": email}
+    return _ENCODER.encode(bundle)
+
+
+def get_order_bundle(checkout, total, email=None, default_vat_rate=DEFAULT_VAT_RATE):
+    """Build the orderBundle of a checkout with a single query for its lines."""
+    lines = checkout.lines.select_related(
+        "variant__product__product_type"
+    ).order_by("pk")
+    line_data = (
+        (
+            " ".join(filter(None, (line.variant.product.name, line.variant.name))),
+            line.variant.sku,
+            line.quantity,
+            line.variant.price_amount,
+            line.variant.product.product_type,
+        )
+        for line in lines
+    )
+    shipping = None
+    if checkout.shipping_method_id:
+        shipping_method = checkout.shipping_method
+        shipping = (shipping_method.name, shipping_method.price.amount)
+    return build_order_bundle(
+        line_data, total, email=email, shipping=shipping, default_vat_rate=default_vat_rate
+    )
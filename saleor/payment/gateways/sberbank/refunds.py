@@ -0,0 +1,332 @@
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Iterable, List, Tuple
+
+from django.db import transaction
+from django.utils import timezone
+
+from ... import ChargeStatus, TransactionKind
+from ...models import Payment, Transaction
+from .client import PRIORITY
+from .db import mark_written
+from .live_status import publish_status
+from .utils import (
+    get_amount_for_sberbank,
+    get_channel_slug,
+    get_client,
+    get_order_id,
+    is_success_response,
+)
+
+logger = logging.getLogger(__name__)
+
+REFUND_CHUNK_SIZE = 200
+REFUND_MAX_WORKERS = 8
+
+
+@dataclass
+class RefundResult:
+    total: int = 0
+    succeeded: List[str] = field(default_factory=list)
+    failed: List[str] = field(default_factory=list)
+
+
+def get_idempotency_key(batch_id: str, payment_id: int, amount: Decimal) -> str:
+    value = "{}:{}:{}".format(batch_id, payment_id, Decimal(amount).normalize())
+    return "sberbank-refund:" + hashlib.sha1(value.encode()).hexdigest()
+
+
+def _get_kind(payment: Payment) -> str:
+    """Uncaptured payments are reversed, in part or whole, captured ones refunded."""
+    if payment.charge_status == ChargeStatus.NOT_CHARGED:
+        return TransactionKind.VOID
+    return TransactionKind.REFUND
+
+
+def _get_recorded(payment: Payment, kind: str) -> Decimal:
+    """Amount of successful transactions of a kind, from prefetched transactions."""
+    return sum(
+        (
+            txn.amount
+            for txn in payment.transactions.all()
+            if txn.kind == kind and txn.is_success
+        ),
+        Decimal(0),
+    )
+
+
+def _get_refundable(payment: Payment) -> Decimal:
+    """Amount that can still be reversed or refunded."""
+    if payment.charge_status == ChargeStatus.NOT_CHARGED:
+        if not payment.is_active:
+            return Decimal(0)
+        return payment.total - _get_recorded(payment, TransactionKind.VOID)
+    if payment.charge_status in (
+        ChargeStatus.PARTIALLY_CHARGED,
+        ChargeStatus.FULLY_CHARGED,
+        ChargeStatus.PARTIALLY_REFUNDED,
+    ):
+        return payment.captured_amount
+    return Decimal(0)
+
+
+def _create_intents(refunds, batch_id):
+    """Record every refund as a pending transaction before calling Sberbank.
+
+    Keys that already have a transaction come from an earlier, interrupted
+    run and are reused, so nothing is ever refunded twice. Refunds of unknown
+    payments or above the refundable amount, counting the earlier refunds of
+    the batch, are rejected without a transaction.
+    """
+    keys = {
+        get_idempotency_key(batch_id, payment_id, amount): (payment_id, Decimal(amount))
+        for payment_id, amount in refunds
+    }
+    existing = dict(
+        Transaction.objects.filter(searchable_key__in=keys).values_list(
+            "searchable_key", "is_success"
+        )
+    )
+    payments = (
+        Payment.objects.filter(gateway="korolev.payments.sberbank")
+        .prefetch_related("transactions")
+        .in_bulk({payment_id for payment_id, _ in keys.values()})
+    )
+
+    intents = []
+    rejected = set()
+    refundable = {}
+    for key, (payment_id, amount) in keys.items():
+        payment = payments.get(payment_id)
+        if payment is None:
+            rejected.add(key)
+            continue
+        if payment_id not in refundable:
+            refundable[payment_id] = _get_refundable(payment)
+        if key in existing:
+            # Succeeded refunds are already out of the payment amounts.
+            if not existing[key]:
+                refundable[payment_id] -= amount
+            continue
+        if amount <= 0 or amount > refundable[payment_id]:
+            logger.warning(
+                "Sberbank refund of %s for payment %s rejected, %s refundable",
+                amount,
+                payment_id,
+                refundable[payment_id],
+            )
+            rejected.add(key)
+            continue
+        refundable[payment_id] -= amount
+        intents.append(
+            Transaction(
+                payment=payment,
+                kind=_get_kind(payment),
+                token="",
+                is_success=False,
+                action_required=True,
+                amount=amount,
+                currency=payment.currency,
+                gateway_response={},
+                searchable_key=key,
+            )
+        )
+    Transaction.objects.bulk_create(intents)
+    return keys, set(existing), rejected
+
+
+def _already_done(client, intent: Transaction, done_before: Decimal) -> bool:
+    """Check Sberbank for refunds sent before a crash but never recorded.
+
+    `done_before` is the amount of the same kind already refunded or reversed
+    before this intent, the intents of a payment are sent in pk order.
+    """
+    response = client.payment.get_status(
+        order_id=intent.payment_id, priority=PRIORITY.BACKGROUND
+    )
+    if intent.kind == TransactionKind.VOID:
+        if str(response.get("orderStatus")) == "3":
+            return True
+        # A partial reversal leaves the order approved for a smaller amount.
+        approved = response.get("paymentAmountInfo", {}).get("approvedAmount")
+        remaining = intent.payment.total - done_before - intent.amount
+        return approved is not None and int(approved) <= get_amount_for_sberbank(
+            remaining
+        )
+    refunded = response.get("paymentAmountInfo", {}).get("refundedAmount", 0)
+    return int(refunded) >= get_amount_for_sberbank(done_before + intent.amount)
+
+
+def _send(intent: Transaction, client, order_id, resumed, done_before):
+    try:
+        if resumed and _already_done(client, intent, done_before):
+            return intent, {"resumed": True}, True
+        if intent.kind == TransactionKind.VOID:
+            partial = intent.amount < intent.payment.total
+            response = client.reverse.create(
+                order_id=order_id,
+                amount=get_amount_for_sberbank(intent.amount) if partial else None,
+                priority=PRIORITY.BACKGROUND,
+            )
+        else:
+            response = client.refund.create(
+                order_id=order_id,
+                amount=get_amount_for_sberbank(intent.amount),
+                priority=PRIORITY.BACKGROUND,
+            )
+    except Exception as exc:
+        logger.warning("Sberbank refund %s failed: %s", intent.searchable_key, exc)
+        return intent, {"errorMessage": str(exc)}, False
+    return intent, response, is_success_response(response)
+
+
+def _send_payment_refunds(intents, order_id, channel_slug, connection_params, resumed_keys):
+    """Send the refunds of one payment one after another, in pk order.
+
+    An interrupted run then leaves a prefix of them done in Sberbank, which
+    is what the resume check counts on.
+    """
+    if not order_id:
+        return [
+            (intent, {"errorMessage": "Missing Sberbank orderId"}, False)
+            for intent in intents
+        ]
+    client = get_client(connection_params, channel_slug)
+    payment = intents[0].payment
+    done = {
+        kind: _get_recorded(payment, kind)
+        for kind in (TransactionKind.VOID, TransactionKind.REFUND)
+    }
+    results = []
+    for intent in intents:
+        result = _send(
+            intent,
+            client,
+            order_id,
+            intent.searchable_key in resumed_keys,
+            done[intent.kind],
+        )
+        if result[2]:
+            done[intent.kind] += intent.amount
+        results.append(result)
+    return results
+
+
+def _store_results(results):
+    refunded_payments = {}
+    reversed_amounts = {}
+    now = timezone.now()
+    for intent, response, is_success in results:
+        # Several refunds of one payment must update the same instance.
+        payment = refunded_payments.get(intent.payment_id, intent.payment)
+        intent.is_success = is_success
+        intent.error = "" if is_success else response.get("errorMessage", "")
+        intent.gateway_response = response
+        # Failed intents stay action_required, so a later run retries them.
+        intent.action_required = not is_success
+        if not is_success:
+            continue
+        if intent.kind == TransactionKind.VOID:
+            if payment.pk not in reversed_amounts:
+                reversed_amounts[payment.pk] = _get_recorded(payment, TransactionKind.VOID)
+            reversed_amounts[payment.pk] += intent.amount
+            # Only a fully released authorization ends the payment.
+            if reversed_amounts[payment.pk] >= payment.total:
+                payment.is_active = False
+        else:
+            payment.captured_amount -= intent.amount
+            payment.charge_status = (
+                ChargeStatus.FULLY_REFUNDED
+                if payment.captured_amount <= 0
+                else ChargeStatus.PARTIALLY_REFUNDED
+            )
+        payment.modified = now
+        refunded_payments[payment.pk] = payment
+
+    with transaction.atomic():
+        Transaction.objects.bulk_update(
+            [intent for intent, _, _ in results],
+            ["is_success", "error", "gateway_response", "action_required"],
+        )
+        Payment.objects.bulk_update(
+            refunded_payments.values(),
+            ["captured_amount", "charge_status", "is_active", "modified"],
+        )
+    mark_written(*{intent.payment_id for intent, _, _ in results})
+    publish_status(*refunded_payments)
+
+
+def refund_payments(
+    refunds: Iterable[Tuple[int, Decimal]],
+    connection_params,
+    batch_id: str,
+    max_workers: int = REFUND_MAX_WORKERS,
+    chunk_size: int = REFUND_CHUNK_SIZE,
+) -> RefundResult:
+    """Refund or reverse many Sberbank payments concurrently.
+
+    `refunds` is a list of (payment id, amount) pairs and `batch_id` a
+    caller-chosen id unique to the batch, e.g. a uuid4. Each pair gets an
+    idempotency key within the batch and is written as a pending transaction
+    first, so a batch interrupted by a crash can be run again with the same
+    id and input and only the unfinished refunds are sent. Refunds above the
+    refundable amount of a payment are reported as failed without a request.
+    """
+    refunds = list(refunds)
+    keys, resumed_keys, rejected_keys = _create_intents(refunds, batch_id)
+
+    pending = list(
+        Transaction.objects.filter(searchable_key__in=keys, action_required=True)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+    result = RefundResult(total=len(keys), failed=list(rejected_keys))
+    result.succeeded.extend(
+        Transaction.objects.filter(
+            searchable_key__in=keys, is_success=True
+        ).values_list("searchable_key", flat=True)
+    )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(pending), chunk_size):
+            intents = list(
+                Transaction.objects.filter(pk__in=pending[start : start + chunk_size])
+                .select_related("payment__order", "payment__checkout")
+                .prefetch_related("payment__transactions")
+                .order_by("pk")
+            )
+            by_payment = {}
+            for intent in intents:
+                by_payment.setdefault(intent.payment_id, []).append(intent)
+            futures = [
+                executor.submit(
+                    _send_payment_refunds,
+                    payment_intents,
+                    get_order_id(payment_intents[0].payment),
+                    get_channel_slug(
+                        payment_intents[0].payment.order
+                        or payment_intents[0].payment.checkout
+                    ),
+                    connection_params,
+                    resumed_keys,
+                )
+                for payment_intents in by_payment.values()
+            ]
+            results = [result for future in futures for result in future.result()]
+            _store_results(results)
+            for intent, _, is_success in results:
+                (result.succeeded if is_success else result.failed).append(
+                    intent.searchable_key
+                )
+
+    logger.info(
+        "Sberbank batch %s refunds finished: %s succeeded, %s failed of %s",
+        batch_id,
+        len(result.succeeded),
+        len(result.failed),
+        result.total,
+    )
+    return result
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, List, NamedTuple, Optional
+
+from django.db import connections, transaction
+from django.db.models import F
+
+from ... import ChargeStatus, TransactionKind
+from ...models import Payment, Transaction
+from .client import ORDER_STATUS, OrderStatus
+from .db import mark_written
+from .status import classify_status
+
+logger = logging.getLogger(__name__)
+
+REPLAY_CHUNK_SIZE = 1000
+
+REPLAY_FIELDS = ("pk", "payment_id", "kind", "is_success", "gateway_response")
+
+
+class Correction(NamedTuple):
+    transaction_id: int
+    payment_id: int
+    old_kind: str
+    new_kind: str
+    old_is_success: bool
+    new_is_success: bool
+    deposited: bool
+
+    def __str__(self):
+        return "transaction {} (payment {}): kind {} -> {}, is_success {} -> {}".format(
+            self.transaction_id,
+            self.payment_id,
+            self.old_kind,
+            self.new_kind,
+            self.old_is_success,
+            self.new_is_success,
+        )
+
+
+@dataclass
+class ReplayResult:
+    scanned: int = 0
+    corrections: int = 0
+    last_pk: int = 0
+
+
+def get_replay_transactions():
+    """Sberbank registration transactions with a stored final order status."""
+    return Transaction.objects.filter(
+        payment__gateway="korolev.payments.sberbank",
+        kind__in=[TransactionKind.AUTH, TransactionKind.CAPTURE],
+        action_required=False,
+        gateway_response__has_key="orderStatus",
+    )
+
+
+def classify_chunk(rows) -> List[Correction]:
+    """Re-run the status classification on stored responses.
+
+    Runs in worker processes, so it works on plain rows and never touches the
+    database.
+    """
+    corrections = []
+    for pk, payment_id, kind, is_success, response in rows:
+        status = OrderStatus.from_response(response)
+        if not status.is_terminal:
+            continue
+        new_kind, new_is_success = classify_status(status, kind)
+        if (new_kind, new_is_success) != (kind, is_success):
+            corrections.append(
+                Correction(
+                    pk,
+                    payment_id,
+                    kind,
+                    new_kind,
+                    is_success,
+                    new_is_success,
+                    status.order_status == ORDER_STATUS.DEPOSITED,
+                )
+            )
+    return corrections
+
+
+def apply_corrections(corrections: List[Correction]):
+    if not corrections:
+        return
+    with transaction.atomic():
+        Transaction.objects.bulk_update(
+            [
+                Transaction(pk=c.transaction_id, kind=c.new_kind, is_success=c.new_is_success)
+                for c in corrections
+            ],
+            ["kind", "is_success"],
+        )
+        # Same payment update as apply_terminal_status, refunded or cancelled
+        # payments are left alone.
+        Payment.objects.filter(
+            pk__in={c.payment_id for c in corrections if c.deposited},
+            charge_status__in=[ChargeStatus.NOT_CHARGED, ChargeStatus.PENDING],
+        ).update(charge_status=ChargeStatus.FULLY_CHARGED, captured_amount=F("total"))
+    mark_written(*{c.payment_id for c in corrections})
+
+
+def read_checkpoint(path: Optional[str]) -> int:
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as checkpoint:
+        return json.load(checkpoint)["last_pk"]
+
+
+def write_checkpoint(path: Optional[str], last_pk: int):
+    if not path:
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as checkpoint:
+        json.dump({"last_pk": last_pk}, checkpoint)
+    os.replace(tmp_path, path)
+
+
+def _iter_chunks(transactions, last_pk, chunk_size):
+    while True:
+        rows = list(
+            transactions.filter(pk__gt=last_pk)
+            .order_by("pk")
+            .values_list(*REPLAY_FIELDS)[:chunk_size]
+        )
+        if not rows:
+            return
+        last_pk = rows[-1][0]
+        yield rows
+
+
+def replay_transactions(
+    transactions=None,
+    dry_run: bool = True,
+    checkpoint: Optional[str] = None,
+    from_pk: Optional[int] = None,
+    chunk_size: int = REPLAY_CHUNK_SIZE,
+    max_workers: Optional[int] = None,
+    on_correction: Optional[Callable[[Correction], None]] = None,
+) -> ReplayResult:
+    """Stream stored responses in pk order and correct the derived state.
+
+    Chunks are classified in worker processes, at most two per worker are in
+    flight, so memory stays constant however many transactions are replayed.
+    Corrections are applied and the checkpoint advanced chunk by chunk, in pk
+    order, so an interrupted replay continues where it stopped.
+    """
+    transactions = get_replay_transactions() if transactions is None else transactions
+    last_pk = read_checkpoint(checkpoint) if from_pk is None else from_pk
+    result = ReplayResult(last_pk=last_pk)
+    max_workers = max_workers or os.cpu_count() or 1
+
+    # Forked workers must not share the parent's database connections.
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        in_flight: deque = deque()
+
+        def finish_oldest():
+            chunk_last_pk, size, future = in_flight.popleft()
+            corrections = future.result()
+            if not dry_run:
+                apply_corrections(corrections)
+                write_checkpoint(checkpoint, chunk_last_pk)
+            for correction in corrections:
+                if on_correction:
+                    on_correction(correction)
+            result.scanned += size
+            result.corrections += len(corrections)
+            result.last_pk = chunk_last_pk
+
+        for rows in _iter_chunks(transactions, last_pk, chunk_size):
+            in_flight.append((rows[-1][0], len(rows), executor.submit(classify_chunk, rows)))
+            if len(in_flight) >= max_workers * 2:
+                finish_oldest()
+        while in_flight:
+            finish_oldest()
+
+    logger.info(
+        "Sberbank replay finished at pk %s: %s corrections in %s transactions%s",
+        result.last_pk,
+        result.corrections,
+        result.scanned,
+        " (dry run)" if dry_run else "",
+    )
+    return result
@@ -0,0 +1,51 @@
+import logging
+import zlib
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.db.models.functions import Mod
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARD_COUNT = 16
+
+
+def get_shard_count():
+    return getattr(settings, "SBERBANK_STATUS_SHARDS", DEFAULT_SHARD_COUNT)
+
+
+def filter_shard(payments, shard, shard_count):
+    """Narrow payments to one shard, by primary key modulo the shard count."""
+    return payments.annotate(sberbank_shard=Mod(F("pk"), shard_count)).filter(
+        sberbank_shard=shard
+    )
+
+
+@contextmanager
+def shard_lease(name, shard):
+    """Own a shard of background work for the duration of the block.
+
+    Uses a session level PostgreSQL advisory lock. The lease ends when the
+    block exits or when the holder's database session ends, so the shard of
+    a crashed node becomes free for the next run. Yields False when another
+    node owns the shard. Other databases have no locks and always own it.
+    """
+    if connection.vendor != "postgresql":
+        yield True
+        return
+
+    key = (zlib.crc32(name.encode()) & 0x7FFFFFFF, shard)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", key)
+        acquired = cursor.fetchone()[0]
+    if not acquired:
+        logger.debug("Sberbank %s shard %s is owned by another node", name, shard)
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s, %s)", key)
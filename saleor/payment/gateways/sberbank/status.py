@@ -0,0 +1,129 @@
+import logging
+
+from django.db import DEFAULT_DB_ALIAS
+
+from ... import ChargeStatus, TransactionKind
+from ...models import Payment, Transaction
+from .client import ORDER_STATUS, PRIORITY
+from .db import get_read_db, mark_written
+from .live_status import publish_status
+from .utils import OUTAGE_EXCEPTIONS, get_channel_slug, get_client, get_order_id
+
+logger = logging.getLogger(__name__)
+
+SWEEP_CHUNK_SIZE = 500
+
+
+def get_pending_payments():
+    """Return Sberbank payments registered in Sberbank but not paid yet.
+
+    The registration transaction waits for the customer with
+    `action_required` set until the order reaches a terminal state.
+    """
+    return Payment.objects.filter(
+        gateway="korolev.payments.sberbank",
+        is_active=True,
+        charge_status__in=[ChargeStatus.NOT_CHARGED, ChargeStatus.PENDING],
+        transactions__action_required=True,
+        transactions__is_success=True,
+    ).distinct()
+
+
+def classify_status(status, kind):
+    """Return the transaction kind and success for a terminal order status.
+
+    Failed orders keep the kind the transaction was created with.
+    """
+    if not status.is_paid:
+        return kind, False
+    if status.order_status == ORDER_STATUS.DEPOSITED:
+        return TransactionKind.CAPTURE, True
+    return TransactionKind.AUTH, True
+
+
+def apply_terminal_status(payment: Payment, order_id, status, response):
+    """Store the final Sberbank state on the registration transaction.
+
+    The payment may come from a read replica, so everything here explicitly
+    reads and writes the primary database.
+    """
+    transaction = (
+        Transaction.objects.using(DEFAULT_DB_ALIAS)
+        .filter(payment_id=payment.pk, token=order_id)
+        .order_by("pk")
+        .first()
+    )
+    if transaction is None:
+        logger.warning("No Sberbank transaction %s for payment %s", order_id, payment.pk)
+        return
+
+    transaction.gateway_response = response
+    transaction.action_required = False
+    transaction.kind, transaction.is_success = classify_status(status, transaction.kind)
+    if not status.is_paid:
+        transaction.error = status.error_message or ""
+    transaction.save()
+
+    if status.order_status == ORDER_STATUS.DEPOSITED:
+        payment.charge_status = ChargeStatus.FULLY_CHARGED
+        payment.captured_amount = payment.total
+        payment.save(
+            using=DEFAULT_DB_ALIAS,
+            update_fields=["charge_status", "captured_amount", "modified"],
+        )
+    mark_written(payment.pk)
+    publish_status(payment.pk)
+
+
+def check_payment_status(payment: Payment, connection_params, order_id=None):
+    """Probe the order state and fetch the extended status only when final.
+
+    Pending orders cost one call to the minimal status endpoint. Returns the
+    probed OrderStatus, or None when the payment was never registered.
+    """
+    order_id = order_id or get_order_id(payment)
+    if not order_id:
+        return None
+    client = get_client(
+        connection_params, get_channel_slug(payment.order or payment.checkout)
+    )
+    status = client.payment.probe_status(order_id=order_id, priority=PRIORITY.BACKGROUND)
+    if status.is_terminal:
+        response = client.payment.get_status(
+            order_id=payment.pk, priority=PRIORITY.BACKGROUND
+        )
+        apply_terminal_status(payment, order_id, status, response)
+    return status
+
+
+def sweep_pending_payments(payments, connection_params, chunk_size=SWEEP_CHUNK_SIZE):
+    """Check the status of pending payments chunk by chunk.
+
+    Stops at the first outage, the remaining payments stay pending and are
+    picked up by the next sweep. Returns the number of payments that reached
+    a terminal state. Payments are listed from the read replica.
+    """
+    payments = payments.using(get_read_db(connection_params))
+    finished = 0
+    last_pk = 0
+    while True:
+        chunk = list(
+            payments.filter(pk__gt=last_pk)
+            .order_by("pk")
+            .select_related("order", "checkout")
+            .prefetch_related("transactions")[:chunk_size]
+        )
+        if not chunk:
+            return finished
+        for payment in chunk:
+            try:
+                status = check_payment_status(payment, connection_params)
+            except OUTAGE_EXCEPTIONS:
+                logger.warning("Sberbank is unavailable, status sweep stopped")
+                return finished
+            except Exception:
+                logger.exception("Sberbank status check of payment %s failed", payment.pk)
+                continue
+            if status is not None and status.is_terminal:
+                finished += 1
+        last_pk = chunk[-1].pk
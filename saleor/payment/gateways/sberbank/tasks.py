@@ -1,28 +1,147 @@
+from decimal import Decimal
+
+from celery.signals import worker_process_init
+
 from ....celeryconf import app
-from . import client as sberbank
-from ...models import Payment, Transaction
+from ...models import Transaction
 from ...utils import TransactionKind
+from .capture import capture_payments, get_capturable_payments
+from .db import get_read_db
+from .expiry import expire_pending_payments, get_expired_payments, get_session_timeout
+from .notifications import drain_notifications
+from .offline_queue import drain, park_status_check
+from .refunds import refund_payments
+from .sharding import filter_shard, get_shard_count, shard_lease
+from .status import check_payment_status, get_pending_payments, sweep_pending_payments
+from .utils import OUTAGE_EXCEPTIONS, get_plugin_config
+from .warmup import warm_up_worker
+
+worker_process_init.connect(warm_up_worker, weak=False)
+
+
+def get_connection_params():
+    """Connection params for periodic tasks, which get no arguments."""
+    config = get_plugin_config()
+    return config.connection_params if config else None
 
 
 @app.task(bind=True, default_retry_delay=60, time_limit=1200)
-def check_status_sberbank_task(self, order_id, connection_params):
-    sberbank_client = sberbank.Client(auth=(connection_params['login'], connection_params['password']),
-                                      sandbox=connection_params['sandbox_mode'])
+def check_status_sberbank_task(self, order_id, connection_params, channel_slug=None):
+    # The registration transaction comes first, a CAPTURE one recorded later
+    # shares its token.
+    transactions = (
+        Transaction.objects.select_related("payment")
+        .filter(token=order_id, kind__in=[TransactionKind.AUTH, TransactionKind.CAPTURE])
+        .order_by("pk")
+    )
+    # A task queued right after registration may be ahead of the replica.
+    txn = (
+        transactions.using(get_read_db(connection_params)).first()
+        or transactions.first()
+    )
+    if txn is None:
+        return 'No transaction for Sberbank order ' + str(order_id)
+    try:
+        status = check_payment_status(txn.payment, connection_params, order_id=order_id)
+    except OUTAGE_EXCEPTIONS:
+        # Retrying against a gateway that is down only adds load, the check
+        # waits in the offline queue until Sberbank is back.
+        park_status_check(txn.payment_id, order_id)
+        return 'Sberbank is unavailable, status check parked for ' + str(order_id)
+    if not status.is_terminal:
+        self.retry(countdown=60)
+    if status.is_paid:
+        return 'Success pay on Sberbank for ' + str(order_id)
+    return 'Payment on Sberbank failed for ' + str(order_id)
 
-    response = sberbank_client.payment.get_status(order_id=order_id)
 
-    txn = Transaction.objects.get(token=order_id)
-    if response['actionCode'] == 0:
+@app.task
+def sweep_pending_sberbank_payments_task(connection_params=None):
+    shard_count = get_shard_count()
+    for shard in range(shard_count):
+        sweep_sberbank_shard_task.delay(shard, connection_params, shard_count)
 
-        txn.is_success = True
-        txn.kind = TransactionKind.CAPTURE
-        txn.save()
 
-        payment = Payment.objects.get(pk=txn.payment_id)
-        payment.charge_status = 'fully-charged'
-        payment.captured_amount = payment.total
-        payment.save()
+@app.task
+def sweep_sberbank_shard_task(shard, connection_params=None, shard_count=None):
+    connection_params = connection_params or get_connection_params()
+    if connection_params is None:
+        return None
+    shard_count = shard_count or get_shard_count()
+    with shard_lease("sweep", shard) as owned:
+        if not owned:
+            return None
+        payments = filter_shard(get_pending_payments(), shard, shard_count)
+        return sweep_pending_payments(payments, connection_params)
 
-        return 'Success pay on Sberbank for ' + str(order_id)
-    else:
-        self.retry(countdown=60)
+
+@app.task
+def expire_sberbank_payments_task(connection_params=None):
+    shard_count = get_shard_count()
+    for shard in range(shard_count):
+        expire_sberbank_shard_task.delay(shard, connection_params, shard_count)
+
+
+@app.task
+def expire_sberbank_shard_task(shard, connection_params=None, shard_count=None):
+    connection_params = connection_params or get_connection_params()
+    if connection_params is None:
+        return None
+    shard_count = shard_count or get_shard_count()
+    with shard_lease("expiry", shard) as owned:
+        if not owned:
+            return None
+        return expire_pending_payments(
+            connection_params,
+            reverse=connection_params.get("reverse_expired", False),
+            payments=filter_shard(
+                get_expired_payments(get_session_timeout(connection_params)),
+                shard,
+                shard_count,
+            ),
+        )
+
+
+@app.task
+def drain_sberbank_offline_queue_task(connection_params=None, batch_size=100, rate=1.0):
+    connection_params = connection_params or get_connection_params()
+    if connection_params is None:
+        return None
+    return drain(connection_params, batch_size=batch_size, rate=rate)
+
+
+@app.task(bind=True)
+def capture_sberbank_payments_task(self, payment_ids, connection_params):
+    def report_progress(result):
+        self.update_state(
+            state="PROGRESS", meta={"done": result.done, "total": result.total}
+        )
+
+    result = capture_payments(
+        get_capturable_payments(payment_ids),
+        connection_params,
+        progress=report_progress,
+    )
+    return {"captured": result.captured, "failed": result.failed}
+
+
+@app.task
+def refund_sberbank_payments_task(refunds, connection_params, batch_id):
+    result = refund_payments(
+        [(payment_id, Decimal(amount)) for payment_id, amount in refunds],
+        connection_params,
+        batch_id,
+    )
+    return {"succeeded": result.succeeded, "failed": result.failed}
+
+
+@app.task
+def process_sberbank_notifications_task():
+    config = get_plugin_config()
+    if config is None:
+        return None
+    # A single drainer keeps the notifications of a payment in order.
+    with shard_lease("notifications", 0) as owned:
+        if not owned:
+            return None
+        return drain_notifications(config)
@@ -0,0 +1,88 @@
+import time
+from decimal import Decimal
+from unittest import mock
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from .... import TransactionKind
+from ....utils import create_payment
+from ..webhooks import handle_api_response
+
+FAILED_RESPONSE = {"errorCode": "2", "errorMessage": "Заказ отклонен"}
+SUCCESS_RESPONSE = {
+    "errorCode": "0",
+    "errorMessage": "Успешно",
+    "attributes": [{"name": "mdOrder", "value": "8f1b7a3e-2c44-4f0e-9d4b"}],
+}
+# Tables only complete_checkout needs, see load_checkout_graph.
+GRAPH_TABLES = ("checkout_checkoutline", "giftcard_giftcard")
+MAX_SECONDS = 0.5
+
+
+@pytest.fixture
+def payment_sberbank_for_checkout(checkout_with_item):
+    checkout_with_item.email = "customer@example.com"
+    checkout_with_item.save(update_fields=["email"])
+    return create_payment(
+        gateway="korolev.payments.sberbank",
+        payment_token="",
+        total=Decimal("80.00"),
+        currency="RUB",
+        email=checkout_with_item.email,
+        checkout=checkout_with_item,
+        return_url="https://www.example.com/checkout/payment-confirm",
+    )
+
+
+def _handle(payment, response):
+    with CaptureQueriesContext(connection) as context:
+        started = time.perf_counter()
+        handle_api_response(payment, response)
+        elapsed = time.perf_counter() - started
+    sql = " ".join(query["sql"] for query in context.captured_queries)
+    return len(context.captured_queries), sql, elapsed
+
+
+def _complete_checkout(checkout, **_kwargs):
+    # The graph has to be on the locked checkout before the order is created.
+    assert {"lines", "gift_cards"} <= set(checkout._prefetched_objects_cache)
+    return None, False, {}
+
+
+@mock.patch(
+    "saleor.payment.gateways.sberbank.webhooks.complete_checkout",
+    side_effect=_complete_checkout,
+)
+def test_handle_api_response_failure_skips_checkout_graph(
+    complete_checkout_mock, payment_sberbank_for_checkout
+):
+    payment = payment_sberbank_for_checkout
+
+    _, sql, elapsed = _handle(payment, FAILED_RESPONSE)
+
+    complete_checkout_mock.assert_not_called()
+    assert not any(table in sql for table in GRAPH_TABLES)
+    assert elapsed < MAX_SECONDS
+    transaction = payment.transactions.get()
+    assert transaction.kind == TransactionKind.ACTION_TO_CONFIRM
+    assert not transaction.is_success
+
+
+@mock.patch(
+    "saleor.payment.gateways.sberbank.webhooks.complete_checkout",
+    side_effect=_complete_checkout,
+)
+def test_handle_api_response_success_loads_checkout_graph(
+    complete_checkout_mock, payment_sberbank_for_checkout
+):
+    payment = payment_sberbank_for_checkout
+
+    failure_queries, _, _ = _handle(payment, FAILED_RESPONSE)
+    queries, sql, elapsed = _handle(payment, SUCCESS_RESPONSE)
+
+    complete_checkout_mock.assert_called_once()
+    assert all(table in sql for table in GRAPH_TABLES)
+    assert queries > failure_queries
+    assert elapsed < MAX_SECONDS
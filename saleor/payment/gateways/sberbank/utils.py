@@ -1,11 +1,25 @@
+import logging
 from decimal import Decimal
 
+import requests
+
 # from ..sberbank import SBERBANK_EXCEPTIONS, logger
 from . import client as sberbank
 from ... import PaymentError
 from ...models import Order
 from .errors import ERRORS as FAILED_STATUSES
 
+logger = logging.getLogger(__name__)
+
+# Errors meaning Sberbank is unreachable rather than rejecting the request.
+OUTAGE_EXCEPTIONS = (
+    requests.RequestException,
+    sberbank.errors.CircuitOpenError,
+    sberbank.errors.GatewayError,
+    sberbank.errors.RateLimitError,
+    sberbank.errors.ServerError,
+)
+
 
 def get_error_response(amount: Decimal, **additional_kwargs) -> dict:
     """Create a placeholder response for invalid or failed requests.
@@ -34,21 +48,125 @@ def get_return_url(order_id):
     #return build_absolute_uri(reverse("order:payment-success", kwargs={"token": get_order_token(order_id)}))
     return ('http://localhost:3000/checkout/review')
 
-def get_data_for_payment(payment_information):
+def get_data_for_payment(payment_information, session_timeout=None,
+                         checkout=None, connection_params=None):
     data = {
         'language': 'ru',
         'currency': 643,
         'email': payment_information.customer_email,
     }
+    if session_timeout:
+        data['sessionTimeoutSecs'] = session_timeout
+    if checkout is not None and connection_params and connection_params.get('send_receipt'):
+        from .receipt import get_order_bundle
+
+        data['orderBundle'] = get_order_bundle(
+            checkout,
+            payment_information.amount,
+            email=payment_information.customer_email,
+            default_vat_rate=connection_params.get('vat_rate'))
+        data['taxSystem'] = connection_params.get('tax_system', 0)
     return data
 
-def api_call(request_data: dict, config):
+def parse_channel_merchants(value, strict=False):
+    """Parse `channel-slug:login:password` entries separated by a comma.
+
+    Malformed entries are skipped, or raise ValueError when `strict`.
+    """
+    merchants = {}
+    for entry in (value or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        parts = [part.strip() for part in entry.split(':', 2)]
+        if len(parts) != 3 or not all(parts):
+            if strict:
+                raise ValueError(entry.split(':', 1)[0])
+            logger.warning("Malformed Sberbank channel merchant entry skipped")
+            continue
+        channel_slug, login, password = parts
+        merchants[channel_slug] = {'login': login, 'password': password}
+    return merchants
+
+
+def parse_number(value, cast, default):
+    """Read a number from a STRING setting, the default when it is invalid."""
+    try:
+        return cast(value) if value not in (None, '') else default
+    except (TypeError, ValueError):
+        logger.warning("Invalid Sberbank setting value %r, using %r", value, default)
+        return default
+
+
+def parse_endpoints(value):
+    """Parse base URLs separated by a comma, as a hashable tuple."""
+    return tuple(url.strip().rstrip('/') for url in (value or '').split(',') if url.strip())
+
+
+def get_channel_slug(checkout):
+    """Return the sales channel of the checkout used to pick a merchant.
+
+    Saleor versions with channels expose them on the checkout, older ones
+    can pass the channel in the checkout metadata.
+    """
+    if checkout is None:
+        return None
+    channel = getattr(checkout, 'channel', None)
+    if channel is not None:
+        return channel.slug
+    get_value_from_metadata = getattr(checkout, 'get_value_from_metadata', None)
+    if get_value_from_metadata:
+        return get_value_from_metadata('channel')
+    return None
+
+
+def get_client(connection_params, channel_slug=None):
+    """Return the pooled Sberbank client of the channel's merchant."""
+    merchant = connection_params.get('merchants', {}).get(channel_slug, connection_params)
+    return sberbank.client_pool.get(
+        merchant['login'],
+        merchant['password'],
+        sandbox=connection_params['sandbox_mode'],
+        max_connections=connection_params.get('max_connections',
+                                              sberbank.pool.DEFAULT_MAX_CONNECTIONS),
+        rate_limit=connection_params.get('rate_limit'),
+        rate_limit_redis_url=connection_params.get('rate_limit_redis_url'),
+        endpoints=connection_params.get('endpoints') or None)
+
+
+def is_success_response(response) -> bool:
+    """Check the errorCode of a Sberbank response against the known failures."""
+    return str(response.get('errorCode')) not in FAILED_STATUSES
+
+
+def get_order_id(payment):
+    """Return the Sberbank orderId the payment was registered with.
+
+    It is the token of the first successful transaction, created by
+    `register.do`. Uses prefetched transactions when available.
+    """
+    transactions = sorted(payment.transactions.all(), key=lambda txn: txn.pk)
+    for transaction in transactions:
+        if transaction.is_success and transaction.token:
+            return transaction.token
+    return None
 
-    sberbank_client = sberbank.Client(
-        auth=(config.connection_params['login'], config.connection_params['password']),
-        sandbox=config.connection_params['sandbox_mode'])
 
-    response = sberbank_client.payment.get_status(order_id=request_data.get('payment_id'))
+def get_plugin_config():
+    """Return the gateway config of the active plugin, None if it is inactive.
+
+    Used by background jobs that are not started from a plugin call.
+    """
+    from ....plugins.manager import get_plugins_manager
+    from .plugin import SberbankGatewayPlugin
+
+    plugin = get_plugins_manager().get_plugin(SberbankGatewayPlugin.PLUGIN_ID)
+    if not plugin or not plugin.active:
+        return None
+    return plugin.config
+
+
+def check_api_response(response):
     result_code = response.get('errorCode')
     is_success = result_code not in FAILED_STATUSES
     if is_success:
@@ -57,4 +175,20 @@ def api_call(request_data: dict, config):
         raise PaymentError(
             code=response.get('errorCode'),
             message=response.get('errorMessage')
-        )
\ No newline at end of file
+        )
+
+
+def api_call(request_data: dict, config):
+
+    sberbank_client = get_client(config.connection_params, request_data.get('channel'))
+
+    response = sberbank_client.payment.get_status(order_id=request_data.get('payment_id'))
+    return check_api_response(response)
+
+
+async def aapi_call(request_data: dict, config):
+    sberbank_client = get_client(config.connection_params, request_data.get('channel'))
+
+    response = await sberbank_client.payment.aget_status(
+        order_id=request_data.get('payment_id'))
+    return check_api_response(response)
\ No newline at end of file
@@ -0,0 +1,17 @@
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotFound
+
+from .utils import get_plugin_config
+from .webhooks import handle_additional_actions_async
+
+
+async def additional_actions(request):
+    """Async variant of the plugin additional-actions webhook.
+
+    Waiting for Sberbank does not hold a worker thread, so an ASGI server can
+    serve many customers returning from the payment page at once.
+    """
+    config = await sync_to_async(get_plugin_config)()
+    if config is None:
+        return HttpResponseNotFound()
+    return await handle_additional_actions_async(request, config)
@@ -0,0 +1,47 @@
+import logging
+import time
+
+from .utils import get_client, get_plugin_config
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up(connection_params, connections):
+    """Build the merchant clients and open their connections in advance."""
+    started = time.monotonic()
+    connections = min(connections, connection_params.get("max_connections", connections))
+    channels = [None, *connection_params.get("merchants", {})]
+    for channel_slug in channels:
+        client = get_client(connection_params, channel_slug)
+        client.warm_up(connections)
+    elapsed = time.monotonic() - started
+    logger.info(
+        "Sberbank warm-up opened %s connections for %s merchants in %.3fs",
+        connections,
+        len(channels),
+        elapsed,
+    )
+    return elapsed
+
+
+def warm_up_worker(**_kwargs):
+    """Warm up the Sberbank clients of a freshly started worker.
+
+    Used as the gunicorn `post_fork` hook and connected to Celery's
+    `worker_process_init` signal. Does nothing unless the active plugin has
+    `Warm-up connections` set. Never raises, a failed warm-up must not
+    abort the worker start.
+    """
+    try:
+        # The lookup needs the database, which may not be ready at fork time.
+        config = get_plugin_config()
+        if config is None:
+            return None
+        connection_params = config.connection_params
+        connections = connection_params.get("warm_up_connections")
+        if not connections:
+            return None
+        return warm_up(connection_params, connections)
+    except Exception:
+        logger.exception("Sberbank warm-up failed")
+        return None
@@ -4,15 +4,18 @@ import hashlib
 import hmac
 import json
 import logging
+from contextvars import ContextVar
+from decimal import Decimal
 from typing import Any, Callable, Dict, Optional
 from urllib.parse import urlencode
 
-import Adyen
 import graphene
+from asgiref.sync import sync_to_async
 from django.contrib.auth.hashers import check_password
 from django.contrib.auth.models import AnonymousUser
 from django.core.exceptions import ValidationError
 from django.core.handlers.wsgi import WSGIRequest
+from django.db.models import prefetch_related_objects
 from django.http import (
     HttpResponse,
     HttpResponseBadRequest,
@@ -40,14 +43,34 @@ from ... import ChargeStatus, PaymentError, TransactionKind
 from ...gateway import payment_refund_or_void
 from ...interface import GatewayConfig, GatewayResponse
 from ...utils import create_payment_information, create_transaction, gateway_postprocess
-from .utils import api_call
+from .client import ORDER_STATUS, PRIORITY, OrderStatus
+from .db import mark_written
+from .live_status import publish_status
+from .offline_queue import park_status_check
+from .status import apply_terminal_status
+from .utils import (
+    OUTAGE_EXCEPTIONS,
+    aapi_call,
+    api_call,
+    get_channel_slug,
+    get_client,
+    get_order_id,
+)
 from .errors import ERRORS as FAILED_STATUSES
 
 logger = logging.getLogger(__name__)
 
+# resultCode of the storefront redirect while Sberbank cannot be asked.
+PENDING_RESULT = "pending"
+
+# Payments locked in bulk by the notification pipeline, keyed by database id.
+prefetched_payments: ContextVar[Optional[Dict[str, Payment]]] = ContextVar(
+    "sberbank_prefetched_payments", default=None
+)
+
 
 def get_payment(
-        payment_id: Optional[str], transaction_id: Optional[str] = None
+        payment_id: Optional[str], transaction_id: Optional[str] = None, lock=True
 ) -> Optional[Payment]:
     transaction_id = transaction_id or ""
     if not payment_id:
@@ -62,12 +85,15 @@ def get_payment(
             transaction_id,
         )
         return None
-    payment = (
-        Payment.objects.prefetch_related("order", "checkout")
-            .select_for_update(of=("self",))
-            .filter(id=db_payment_id, is_active=True, gateway="korolev.payments.sberbank")
-            .first()
-    )
+    prefetched = prefetched_payments.get()
+    if prefetched is not None and db_payment_id in prefetched:
+        return prefetched[db_payment_id]
+    payments = Payment.objects.prefetch_related("order", "checkout")
+    if lock:
+        payments = payments.select_for_update(of=("self",))
+    payment = payments.filter(
+        id=db_payment_id, is_active=True, gateway="korolev.payments.sberbank"
+    ).first()
     if not payment:
         logger.warning(
             "Payment for %s was not found. Reference %s", payment_id, transaction_id
@@ -76,18 +102,31 @@ def get_payment(
 
 
 def get_checkout(payment: Payment) -> Optional[Checkout]:
-    if not payment.checkout:
+    """Lock the checkout of the payment without loading its lines.
+
+    Most responses end without an order, so the graph needed by
+    complete_checkout is only loaded by create_order.
+    """
+    if not payment.checkout_id:
         return None
     # Lock checkout in the same way as in checkoutComplete
     return (
         Checkout.objects.select_for_update(of=("self",))
-            .prefetch_related("gift_cards", "lines__variant__product", )
-            .select_related("shipping_method__shipping_zone")
-            .filter(pk=payment.checkout.pk)
+            .filter(pk=payment.checkout_id)
             .first()
     )
 
 
+def load_checkout_graph(checkout: Checkout):
+    """Fetch what complete_checkout reads, onto the already locked checkout."""
+    prefetch_related_objects(
+        [checkout],
+        "gift_cards",
+        "lines__variant__product",
+        "shipping_method__shipping_zone",
+    )
+
+
 def get_transaction(
         payment: "Payment", transaction_id: Optional[str], kind: str,
 ) -> Optional[Transaction]:
@@ -139,6 +178,7 @@ def create_payment_notification_for_order(
 
 
 def create_order(payment, checkout):
+    load_checkout_graph(checkout)
     try:
         discounts = fetch_active_discounts()
         order, _, _ = complete_checkout(
@@ -180,41 +220,213 @@ def handle_not_created_order(notification, payment, checkout):
     return None
 
 
+def _with_amount(notification: Dict[str, Any], payment: Payment, default):
+    """Fill in the amount and currency Sberbank callbacks may leave out."""
+    value = notification.get("amount", {}).get("value") or default
+    return dict(notification, amount={"value": value, "currency": payment.currency})
+
+
+def _finish_registration(
+        notification, payment: Payment, expected, gateway_config: GatewayConfig
+) -> bool:
+    """Apply a final status to a payment still waiting for the customer.
+
+    The callback is only a hint, the status is confirmed with
+    getOrderStatusExtended.do and applied as Sberbank reports it. Returns
+    False when the registration was already finished, by the redirect
+    handler, the status sweep or an earlier notification, or when Sberbank
+    reports none of the `expected` order statuses.
+    """
+    order_id = notification.get("pspReference")
+    if not payment.transactions.filter(token=order_id, action_required=True).exists():
+        return False
+    client = get_client(
+        gateway_config.connection_params, get_channel_slug(payment.order or payment.checkout)
+    )
+    response = client.payment.get_status(order_id=payment.pk, priority=PRIORITY.BACKGROUND)
+    status = OrderStatus.from_response(response)
+    if status.order_status not in expected:
+        logger.warning(
+            "Sberbank %s notification of payment %s not confirmed, order status %s",
+            notification.get("eventCode"),
+            payment.pk,
+            status.order_status,
+        )
+        return False
+    apply_terminal_status(payment, order_id, status, response)
+    return True
+
+
+def _complete_order(notification, payment: Payment):
+    """Create the order of a paid payment whose customer did not come back."""
+    if payment.order:
+        return
+    checkout = get_checkout(payment)
+    if checkout:
+        create_order(payment, checkout)
+
+
 def handle_authorization(notification: Dict[str, Any], gateway_config: GatewayConfig):
-    # TODO: handle_authorization
-    pass
+    payment = get_payment(notification.get("merchantReference"), notification.get("pspReference"))
+    if not payment:
+        return
+    if notification.get("success") != "true":
+        if _finish_registration(
+                notification, payment, (ORDER_STATUS.DECLINED,), gateway_config
+        ):
+            payment.is_active = False
+            payment.save(update_fields=["is_active", "modified"])
+        return
+    if not _finish_registration(notification, payment, ORDER_STATUS.PAID, gateway_config):
+        return
+    if payment.order:
+        order_authorized(payment.order, None, payment.total, payment)
+    else:
+        _complete_order(notification, payment)
+    create_payment_notification_for_order(
+        payment, "Sberbank: payment authorized", None, True
+    )
 
 
-def handle_cancellation(notification: Dict[str, Any], _gateway_config: GatewayConfig):
-    # TODO: handle_cancellation
-    pass
+def handle_cancellation(notification: Dict[str, Any], gateway_config: GatewayConfig):
+    payment = get_payment(notification.get("merchantReference"), notification.get("pspReference"))
+    if not payment:
+        return
+    if notification.get("success") != "true":
+        create_payment_notification_for_order(
+            payment, "", "Sberbank: payment cancellation failed", False
+        )
+        return
+    if _finish_registration(
+            notification,
+            payment,
+            (ORDER_STATUS.REVERSED, ORDER_STATUS.DECLINED),
+            gateway_config,
+    ):
+        # Never paid, there is nothing to void.
+        payment.is_active = False
+        payment.save(update_fields=["is_active", "modified"])
+        publish_status(payment.pk)
+        return
+    transaction = create_new_transaction(
+        _with_amount(notification, payment, payment.total), payment, TransactionKind.VOID
+    )
+    gateway_postprocess(transaction, payment)
+    publish_status(payment.pk)
+    if payment.order:
+        cancel_order(payment.order, None)
+    create_payment_notification_for_order(
+        payment, "Sberbank: payment cancelled", None, True
+    )
 
 
 def handle_cancel_or_refund(
         notification: Dict[str, Any], gateway_config: GatewayConfig
 ):
-    # TODO: handle_cancel_or_refund
-    pass
+    payment = get_payment(notification.get("merchantReference"), notification.get("pspReference"))
+    if not payment:
+        return
+    if payment.charge_status == ChargeStatus.NOT_CHARGED:
+        handle_cancellation(notification, gateway_config)
+    else:
+        handle_refund(notification, gateway_config)
 
 
-def handle_capture(notification: Dict[str, Any], _gateway_config: GatewayConfig):
-    # TODO: handle_capture
-    pass
+def handle_capture(notification: Dict[str, Any], gateway_config: GatewayConfig):
+    payment = get_payment(notification.get("merchantReference"), notification.get("pspReference"))
+    if not payment:
+        return
+    # One-stage payments are deposited right away, the notification is the
+    # first news of the payment.
+    if _finish_registration(
+            notification, payment, (ORDER_STATUS.DEPOSITED,), gateway_config
+    ):
+        if payment.order:
+            order_captured(payment.order, None, payment.total, payment)
+        else:
+            _complete_order(notification, payment)
+        return
+
+    transaction = get_transaction(
+        payment, notification.get("pspReference"), TransactionKind.CAPTURE
+    )
+    if transaction and transaction.is_success:
+        # Already recorded by the batch capture.
+        return
+    transaction = create_new_transaction(
+        _with_amount(notification, payment, payment.total - payment.captured_amount),
+        payment,
+        TransactionKind.CAPTURE,
+    )
+    gateway_postprocess(transaction, payment)
+    publish_status(payment.pk)
+    if payment.order:
+        order_captured(payment.order, None, transaction.amount, payment)
+    create_payment_notification_for_order(
+        payment, "Sberbank: payment captured", None, True
+    )
 
 
 def handle_failed_capture(notification: Dict[str, Any], _gateway_config: GatewayConfig):
-    # TODO: handle_failed_capture
-    pass
+    payment = get_payment(notification.get("merchantReference"), notification.get("pspReference"))
+    if not payment:
+        return
+    create_new_transaction(
+        _with_amount(notification, payment, payment.total - payment.captured_amount),
+        payment,
+        TransactionKind.CAPTURE,
+    )
+    create_payment_notification_for_order(
+        payment, "", "Sberbank: payment capture failed", False
+    )
 
 
 def handle_pending(notification: Dict[str, Any], gateway_config: GatewayConfig):
-    # TODO: handle_pending
+    # Sberbank has no pending callback, the registration stays pending until
+    # a final one arrives.
     pass
 
 
-def handle_refund(notification: Dict[str, Any], _gateway_config: GatewayConfig):
-    # TODO: handle_refund
-    pass
+def handle_refund(notification: Dict[str, Any], gateway_config: GatewayConfig):
+    """Record refunds made in Sberbank but missing in Saleor.
+
+    Callbacks do not identify a single refund, so the refunded total is
+    taken from Sberbank. Refunds sent by Saleor are already recorded and
+    repeated notifications find nothing missing.
+    """
+    payment = get_payment(notification.get("merchantReference"), notification.get("pspReference"))
+    if not payment:
+        return
+    client = get_client(
+        gateway_config.connection_params, get_channel_slug(payment.order or payment.checkout)
+    )
+    response = client.payment.get_status(order_id=payment.pk, priority=PRIORITY.BACKGROUND)
+    refunded = Decimal(
+        response.get("paymentAmountInfo", {}).get("refundedAmount", 0)
+    ) / 100
+    recorded = sum(
+        (
+            txn.amount
+            for txn in payment.transactions.all()
+            if txn.kind == TransactionKind.REFUND and txn.is_success
+        ),
+        Decimal(0),
+    )
+    missing = refunded - recorded
+    if missing <= 0:
+        return
+    transaction = create_new_transaction(
+        dict(notification, amount={"value": missing, "currency": payment.currency}),
+        payment,
+        TransactionKind.REFUND,
+    )
+    gateway_postprocess(transaction, payment)
+    publish_status(payment.pk)
+    if payment.order:
+        order_refunded(payment.order, None, missing, payment)
+    create_payment_notification_for_order(
+        payment, "Sberbank: payment refunded", None, True
+    )
 
 
 def _get_kind(transaction: Optional[Transaction]) -> str:
@@ -225,14 +437,21 @@ def _get_kind(transaction: Optional[Transaction]) -> str:
 
 
 def handle_failed_refund(notification: Dict[str, Any], gateway_config: GatewayConfig):
-    # TODO: handle_failed_refund
-    pass
+    payment = get_payment(notification.get("merchantReference"), notification.get("pspReference"))
+    if not payment:
+        return
+    create_new_transaction(
+        _with_amount(notification, payment, 0), payment, TransactionKind.REFUND
+    )
+    create_payment_notification_for_order(
+        payment, "", "Sberbank: payment refund failed", False
+    )
 
 
 def handle_reversed_refund(
         notification: Dict[str, Any], _gateway_config: GatewayConfig
 ):
-    # TODO: handle_reversed_refund
+    # Sberbank does not reverse refunds.
     pass
 
 
@@ -245,8 +464,7 @@ def handle_refund_with_data(
 def webhook_not_implemented(
         notification: Dict[str, Any], gateway_config: GatewayConfig
 ):
-    # TODO: handle_refund
-    pass
+    logger.info("Sberbank %s notification ignored", notification.get("eventCode"))
 
 
 EVENT_MAP = {
@@ -270,25 +488,20 @@ EVENT_MAP = {
 }
 
 
-@transaction_with_commit_on_errors()
-def handle_additional_actions(
-        request: WSGIRequest, gateway_config: "GatewayConfig"
-):
-    payment_id = request.GET.get("payment")
-    checkout_pk = request.GET.get("checkout")
+def prepare_additional_action(request: WSGIRequest, payment: Optional[Payment], checkout_pk):
+    """Validate the redirect and build the status request.
 
-    if not payment_id or not checkout_pk:
-        return HttpResponseNotFound()
-
-    payment = get_payment(payment_id, transaction_id=None)
+    Returns an error response, or None together with the request data and
+    the storefront return URL.
+    """
     if not payment:
         return HttpResponseNotFound(
             "Cannot perform payment.There is no active sberbank payment."
-        )
+        ), None, None
     if not payment.checkout or str(payment.checkout.token) != checkout_pk:
         return HttpResponseNotFound(
             "Cannot perform payment.There is no checkout with this payment."
-        )
+        ), None, None
 
     extra_data = json.loads(payment.extra_data)
     data = extra_data[-1] if isinstance(extra_data, list) else extra_data
@@ -298,17 +511,53 @@ def handle_additional_actions(
     if not return_url:
         return HttpResponseNotFound(
             "Cannot perform payment. Lack of data about returnUrl."
-        )
+        ), None, None
 
     try:
-        request_data = prepare_api_request_data(request, data, payment.pk, checkout_pk)
+        request_data = prepare_api_request_data(
+            request, data, payment.pk, checkout_pk, get_channel_slug(payment.checkout)
+        )
     except KeyError as e:
+        return HttpResponseBadRequest(e.args[0]), None, None
+    return None, request_data, return_url
+
+
+def handle_unavailable_gateway(payment: Payment, payment_id, checkout_pk, return_url):
+    """Park the status check and send the customer back with a pending result.
+
+    The order is created by the offline queue drain once Sberbank answers.
+    """
+    park_status_check(payment.pk, get_order_id(payment), complete_checkout=True)
+    return redirect(
+        prepare_redirect_url(
+            payment_id, checkout_pk, {"errorMessage": PENDING_RESULT}, return_url
+        )
+    )
+
+
+@transaction_with_commit_on_errors()
+def handle_additional_actions(
+        request: WSGIRequest, gateway_config: "GatewayConfig"
+):
+    payment_id = request.GET.get("payment")
+    checkout_pk = request.GET.get("checkout")
+
+    if not payment_id or not checkout_pk:
+        return HttpResponseNotFound()
+
+    payment = get_payment(payment_id, transaction_id=None)
+    error, request_data, return_url = prepare_additional_action(
+        request, payment, checkout_pk
+    )
+    if error:
+        return error
 
-        return HttpResponseBadRequest(e.args[0])
     try:
         result = api_call(request_data, gateway_config)
     except PaymentError as e:
         return HttpResponseBadRequest(str(e))
+    except OUTAGE_EXCEPTIONS:
+        return handle_unavailable_gateway(payment, payment_id, checkout_pk, return_url)
 
     handle_api_response(payment, result)
 
@@ -316,7 +565,66 @@ def handle_additional_actions(
     return redirect(redirect_url)
 
 
-def prepare_api_request_data(request: WSGIRequest, data: dict, payment_pk, checkout_pk):
+@transaction_with_commit_on_errors()
+def complete_additional_action(payment_id, checkout_pk, result, return_url):
+    """Write section of the async handler, runs with the payment locked.
+
+    The lock was not held while Sberbank was asked, so a repeated redirect
+    may have completed the checkout meanwhile. The checks are repeated and
+    such a request is only redirected.
+    """
+    payment = get_payment(payment_id, transaction_id=None)
+    if not payment:
+        return HttpResponseNotFound(
+            "Cannot perform payment.There is no active sberbank payment."
+        )
+    redirect_url = prepare_redirect_url(payment_id, checkout_pk, result, return_url)
+    if (
+        payment.order_id
+        or not payment.checkout
+        or str(payment.checkout.token) != checkout_pk
+    ):
+        return redirect(redirect_url)
+    handle_api_response(payment, result)
+    return redirect(redirect_url)
+
+
+async def handle_additional_actions_async(request, gateway_config: "GatewayConfig"):
+    """ASGI variant of handle_additional_actions.
+
+    The Sberbank status call is awaited without holding a thread, only the
+    short lookups and the locked write section run as sync code.
+    """
+    payment_id = request.GET.get("payment")
+    checkout_pk = request.GET.get("checkout")
+
+    if not payment_id or not checkout_pk:
+        return HttpResponseNotFound()
+
+    payment = await sync_to_async(get_payment)(payment_id, None, lock=False)
+    error, request_data, return_url = await sync_to_async(prepare_additional_action)(
+        request, payment, checkout_pk
+    )
+    if error:
+        return error
+
+    try:
+        result = await aapi_call(request_data, gateway_config)
+    except PaymentError as e:
+        return HttpResponseBadRequest(str(e))
+    except OUTAGE_EXCEPTIONS:
+        return await sync_to_async(handle_unavailable_gateway)(
+            payment, payment_id, checkout_pk, return_url
+        )
+
+    return await sync_to_async(complete_additional_action)(
+        payment_id, checkout_pk, result, return_url
+    )
+
+
+def prepare_api_request_data(
+        request: WSGIRequest, data: dict, payment_pk, checkout_pk, channel_slug=None
+):
     params = request.GET
     request_data: "QueryDict" = QueryDict("")
 
@@ -334,13 +642,14 @@ def prepare_api_request_data(request: WSGIRequest, data: dict, payment_pk, check
         "data": data,
         "payment_id": payment_pk,
         "checkout_pk": checkout_pk,
+        "channel": channel_slug,
         "details": {key: request_data[key] for key in params},
     }
     return api_request_data
 
 
 def prepare_redirect_url(
-        payment_id: str, checkout_pk: str, api_response: Adyen.Adyen, return_url: str
+        payment_id: str, checkout_pk: str, api_response: dict, return_url: str
 ):
     checkout_id = graphene.Node.to_global_id(
         "Checkout", checkout_pk  # type: ignore
@@ -360,7 +669,7 @@ def prepare_redirect_url(
 
 
 def handle_api_response(
-        payment: Payment, response: Adyen.Adyen,
+        payment: Payment, response: dict,
 ):
     checkout = get_checkout(payment)
     payment_data = create_payment_information(
@@ -397,6 +706,8 @@ def handle_api_response(
         payment_information=payment_data,
         gateway_response=gateway_response,
     )
+    mark_written(payment.pk)
 
     if is_success:
         create_order(payment, checkout)
+    publish_status(payment.pk)
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...gateways.sberbank.benchmarks.hot_paths import (
+    BASELINE_PATH,
+    DEFAULT_ROUNDS,
+    DEFAULT_THRESHOLD,
+    run_gate,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the Sberbank hot paths and fail when one is slower than its "
+        "stored baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--save", action="store_true", help="Store the timings as the baseline."
+        )
+        parser.add_argument("--baseline", default=BASELINE_PATH)
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=DEFAULT_THRESHOLD,
+            help="Allowed slowdown, 0.25 means 25%%.",
+        )
+        parser.add_argument(
+            "--rounds",
+            type=int,
+            default=DEFAULT_ROUNDS,
+            help="Runs whose median is stored or compared.",
+        )
+        parser.add_argument("--repeat", type=int, default=7)
+
+    def handle(self, *args, **options):
+        try:
+            regressions = run_gate(
+                save=options["save"],
+                baseline_path=options["baseline"],
+                threshold=options["threshold"],
+                rounds=options["rounds"],
+                repeat=options["repeat"],
+                write=self.stdout.write,
+            )
+        except FileNotFoundError:
+            raise CommandError(
+                "No baseline at {}, run with --save first".format(options["baseline"])
+            )
+        if regressions:
+            raise CommandError("Regressed: {}".format(", ".join(regressions)))
+        self.stdout.write(self.style.SUCCESS("No regressions"))
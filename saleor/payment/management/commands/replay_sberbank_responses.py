@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from ...gateways.sberbank.replay import REPLAY_CHUNK_SIZE, replay_transactions
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-derive the state of Sberbank transactions from their stored "
+        "gateway responses."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Print the corrections without saving them.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="File storing the last processed pk, the replay resumes from it.",
+        )
+        parser.add_argument(
+            "--from-pk",
+            type=int,
+            help="Start after this transaction pk instead of the checkpoint.",
+        )
+        parser.add_argument("--chunk-size", type=int, default=REPLAY_CHUNK_SIZE)
+        parser.add_argument(
+            "--workers", type=int, help="Number of worker processes, CPU count by default."
+        )
+
+    def handle(self, *args, **options):
+        result = replay_transactions(
+            dry_run=options["dry_run"],
+            checkpoint=options["checkpoint"],
+            from_pk=options["from_pk"],
+            chunk_size=options["chunk_size"],
+            max_workers=options["workers"],
+            on_correction=lambda correction: self.stdout.write(str(correction)),
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                "{} {} corrections in {} transactions, last pk {}".format(
+                    "Found" if options["dry_run"] else "Applied",
+                    result.corrections,
+                    result.scanned,
+                    result.last_pk,
+                )
+            )
+        )